@@ -0,0 +1,3 @@
+"""
+This package contains the performance benchmarks of the Orders microservice.
+"""
@@ -0,0 +1,76 @@
+"""
+Benchmark of reading Orders as read-only records against ORM objects
+
+Seeds ORDERS orders with ITEMS items each, then reads and serializes all of
+them REQUESTS times as Order objects with their items and as OrderRecords
+built from plain rows. It checks that both return the same documents and
+prints the time per item and the peak memory of each path as JSON.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.records \\
+      --orders 20000 --items 5
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from benchmarks.routes import seed
+from service import APP, queries, serializers
+from service.models import db
+from service.routes.common import init_db
+
+
+def read_objects():
+    """ Serializes every Order read as ORM objects """
+    return [order.serialize() for order in Order.base_query().order_by(Order.id)]
+
+
+def read_records():
+    """ Serializes every Order read as OrderRecords """
+    orders, items = queries.order_rows(serializers.OrderRecord.COLUMNS,
+                                       serializers.ItemRecord.COLUMNS)
+    orders = sorted(orders, key=lambda row: row[0])
+    return [order.serialize() for order in serializers.order_records(orders, items)]
+
+
+def measure(read, requests, items):
+    """ Times the reads and traces the peak memory of one of them """
+    latencies = []
+    for _ in range(requests):
+        began = time.perf_counter()
+        documents = read()
+        latencies.append(time.perf_counter() - began)
+        db.session.remove()
+    tracemalloc.start()
+    read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+    best = min(latencies)
+    return {"best_ms": round(best * 1000, 1),
+            "us_per_item": round(best * 1e6 / max(items, 1), 2),
+            "peak_mb": round(peak / 2**20, 1)}, documents
+
+
+def main():
+    """ Runs the benchmark of both read paths """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--items", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=5)
+    args = parser.parse_args()
+
+    APP.logger.setLevel("CRITICAL")
+    init_db()
+    seed(args.orders, args.items)
+    items = args.orders * args.items
+    results = {"database": db.engine.dialect.name, "orders": args.orders,
+               "items": items}
+    results["objects"], objects = measure(read_objects, args.requests, items)
+    results["records"], records = measure(read_records, args.requests, items)
+    results["identical"] = objects == records
+    results["speedup"] = round(results["objects"]["best_ms"] / results["records"]["best_ms"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
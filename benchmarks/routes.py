@@ -0,0 +1,259 @@
+"""
+Latency benchmark of every REST route of the Orders microservice
+
+Seeds ORDERS orders with ITEMS items each using the test factories, then drives
+every route in service/routes/orders.py and service/routes/items.py with the
+Flask test client from CONCURRENCY threads. For every route it reports the
+p50/p95/p99 latency, the throughput and the number of SQL statements a single
+request issues, as JSON that can be kept as a baseline and compared against a
+later run with --baseline.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.routes \\
+      --orders 1000 --items 5 --output baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from benchmarks.stats import summarize
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+
+from factories import ItemFactory, OrderFactory  # noqa: E402 pylint: disable=wrong-import-position,import-error
+from service import APP  # noqa: E402 pylint: disable=wrong-import-position
+from service.models import Order, db  # noqa: E402 pylint: disable=wrong-import-position
+from service.routes.common import init_db  # noqa: E402 pylint: disable=wrong-import-position
+
+SEED_BATCH_SIZE = 1000
+
+
+class Fixture():
+    """ The seeded orders and items that the routes are driven against """
+
+    def __init__(self, order_ids, item_ids, product_ids):
+        self.order_ids = order_ids
+        self.item_ids = item_ids
+        self.product_ids = product_ids
+        self.disposable_order_ids = []
+        self.disposable_item_ids = []
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def next(self, ids):
+        """ Returns the ids in turn so that requests spread over all of them """
+        with self.lock:
+            self.counter += 1
+            return ids[self.counter % len(ids)]
+
+    def take(self, ids):
+        """ Removes and returns an id that a DELETE may consume """
+        with self.lock:
+            return ids.pop()
+
+
+def item_payload():
+    """ Returns the body of a new item """
+    item = ItemFactory.build()
+    return {"product_id": item.product_id, "quantity": item.quantity,
+            "price": item.price}
+
+
+def order_payload():
+    """ Returns the body of a new order """
+    return {"customer_id": 1, "tracking_id": 1, "status": "CREATED",
+            "items": [item_payload()]}
+
+
+# name -> function(fixture) returning (method, url, json body)
+ROUTES = {
+    "GET /orders": lambda f: ("GET", "/api/orders", None),
+    "GET /orders?limit=100": lambda f: ("GET", "/api/orders?limit=100", None),
+    "GET /orders?status=PAID&customer-id": lambda f: (
+        "GET", "/api/orders?status=PAID&customer-id=100", None),
+    "GET /orders?product-id": lambda f: (
+        "GET", f"/api/orders?product-id={f.next(f.product_ids)}", None),
+    "POST /orders": lambda f: ("POST", "/api/orders", order_payload()),
+    "POST /orders/bulk": lambda f: (
+        "POST", "/api/orders/bulk", [order_payload() for _ in range(10)]),
+    "POST /orders/transitions": lambda f: (
+        "POST", "/api/orders/transitions",
+        {"to": "PAID", "ids": [f.next(f.order_ids) for _ in range(10)]}),
+    "GET /orders/stats": lambda f: ("GET", "/api/orders/stats", None),
+    "GET /orders/export": lambda f: ("GET", "/api/orders/export", None),
+    "GET /orders/changes?limit=100": lambda f: (
+        "GET", "/api/orders/changes?limit=100", None),
+    "GET /orders/{id}": lambda f: (
+        "GET", f"/api/orders/{f.next(f.order_ids)}", None),
+    "PUT /orders/{id}": lambda f: (
+        "PUT", f"/api/orders/{f.next(f.order_ids)}",
+        {"customer_id": 1, "tracking_id": 2, "status": "PAID"}),
+    "PUT /orders/{id}/cancel": lambda f: (
+        "PUT", f"/api/orders/{f.next(f.order_ids)}/cancel", None),
+    "DELETE /orders/{id}": lambda f: (
+        "DELETE", f"/api/orders/{f.take(f.disposable_order_ids)}", None),
+    "GET /items": lambda f: ("GET", "/api/items", None),
+    "GET /items?limit=100": lambda f: ("GET", "/api/items?limit=100", None),
+    "GET /items?product-id": lambda f: (
+        "GET", f"/api/items?product-id={f.next(f.product_ids)}", None),
+    "GET /items?min-price&max-quantity": lambda f: (
+        "GET", "/api/items?min-price=1000&max-quantity=100000&limit=100", None),
+    "GET /items/top-products": lambda f: ("GET", "/api/items/top-products", None),
+    "GET /orders/{id}/items": lambda f: (
+        "GET", f"/api/orders/{f.next(f.order_ids)}/items", None),
+    "POST /orders/{id}/items": lambda f: (
+        "POST", f"/api/orders/{f.next(f.order_ids)}/items", item_payload()),
+    "POST /orders/{id}/items/bulk": lambda f: (
+        "POST", f"/api/orders/{f.next(f.order_ids)}/items/bulk",
+        [item_payload() for _ in range(10)]),
+    "GET /orders/{id}/items/{id}": lambda f: (
+        "GET", "/api/orders/{}/items/{}".format(*f.next(f.item_ids)), None),
+    "PUT /orders/{id}/items/{id}": lambda f: (
+        "PUT", "/api/orders/{}/items/{}".format(*f.next(f.item_ids)),
+        item_payload()),
+    "DELETE /orders/{id}/items/{id}": lambda f: (
+        "DELETE", "/api/orders/{}/items/{}".format(
+            *f.take(f.disposable_item_ids)), None),
+}
+
+
+def create_orders(count, items_per_order):
+    """ Creates orders and their items with the test factories """
+    created = []
+    for start in range(0, count, SEED_BATCH_SIZE):
+        batch = []
+        for _ in range(min(SEED_BATCH_SIZE, count - start)):
+            order = OrderFactory.build()
+            order.tracking_id = order.id
+            order.items = ItemFactory.build_batch(items_per_order)
+            batch.append(order)
+        created.extend(Order.create_many(batch))
+    order_ids = [order.id for order in created]
+    item_ids = [(item.order_id, item.id)
+                for order in created for item in order.items]
+    product_ids = [item.product_id for order in created for item in order.items]
+    db.session.remove()
+    return order_ids, item_ids, product_ids
+
+
+def seed(orders, items_per_order):
+    """ Creates the orders and items that every route reads """
+    db.drop_all()
+    db.create_all()
+    return Fixture(*create_orders(orders, items_per_order))
+
+
+def prepare_deletes(name, fixture, count):
+    """ Creates the orders or items that a DELETE route consumes """
+    if name == "DELETE /orders/{id}":
+        fixture.disposable_order_ids = create_orders(count, 1)[0]
+    elif name == "DELETE /orders/{id}/items/{id}":
+        fixture.disposable_item_ids = create_orders(count, 1)[1]
+
+
+def count_queries(client, route, fixture):
+    """ Returns the number of SQL statements that one request issues """
+    statements = []
+
+    def before_cursor_execute(*args):
+        statements.append(args[2])
+
+    method, url, body = route(fixture)
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        client.open(url, method=method, json=body)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+
+def drive(route, fixture, concurrency, requests):
+    """ Sends the requests of one route from concurrency threads """
+    local = threading.local()
+
+    def timed(_):
+        if not hasattr(local, "client"):
+            local.client = APP.test_client()
+        method, url, body = route(fixture)
+        start = time.perf_counter()
+        resp = local.client.open(url, method=method, json=body)
+        resp.get_data()
+        duration = time.perf_counter() - start
+        db.session.remove()
+        return duration, resp.status_code < 400
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies = [duration for duration, _ in results]
+    errors = sum(1 for _, ok in results if not ok)
+    return summarize(latencies, elapsed, errors)
+
+
+def compare(results, baseline):
+    """ Returns the change of every latency figure against a baseline run """
+    changes = {}
+    for name, result in results["routes"].items():
+        before = baseline.get("routes", {}).get(name)
+        if not before:
+            continue
+        changes[name] = {
+            key: round((result[key] - before[key]) / before[key] * 100, 1)
+            for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps")
+            if before.get(key)
+        }
+        changes[name]["queries_per_request"] = (
+            result["queries_per_request"] - before["queries_per_request"])
+    return changes
+
+
+def main():
+    """ Runs the benchmark of every route """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against an earlier output")
+    args = parser.parse_args()
+
+    APP.logger.setLevel("CRITICAL")
+    init_db()
+    fixture = seed(args.orders, args.items)
+
+    client = APP.test_client()
+    results = {
+        "database": db.engine.dialect.name,
+        "orders": args.orders,
+        "items_per_order": args.items,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "routes": {},
+    }
+    for name in args.routes:
+        route = ROUTES[name]
+        prepare_deletes(name, fixture, args.requests + 1)
+        queries = count_queries(client, route, fixture)
+        db.session.remove()
+        result = drive(route, fixture, args.concurrency, args.requests)
+        result["queries_per_request"] = queries
+        results["routes"][name] = result
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            results["change_pct"] = compare(results, json.load(baseline))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
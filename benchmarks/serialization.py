@@ -0,0 +1,64 @@
+"""
+Benchmark of the fast JSON path against marshalling for large lists
+
+Seeds ORDERS orders with ITEMS items each, then requests the same pages of
+GET /api/orders and GET /api/items REQUESTS times with FAST_JSON off and on.
+It checks that both paths return the same bytes and prints the latency of
+each path and the speedup of the fast one as JSON.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.serialization \\
+      --orders 2000 --items 5 --limit 1000
+"""
+import argparse
+import json
+import time
+from benchmarks.routes import seed
+from benchmarks.stats import summarize
+from service import APP
+from service.models import db
+from service.routes.common import init_db
+
+
+def timed_requests(client, url, requests):
+    """ Sends the same GET requests one after the other and times them """
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        began = time.perf_counter()
+        body = client.get(url).get_data()
+        latencies.append(time.perf_counter() - began)
+        db.session.remove()
+    return summarize(latencies, time.perf_counter() - start, 0), body
+
+
+def main():
+    """ Runs the benchmark of both serialization paths """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--items", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    APP.logger.setLevel("CRITICAL")
+    init_db()
+    seed(args.orders, args.items)
+    client = APP.test_client()
+    results = {"database": db.engine.dialect.name, "orders": args.orders,
+               "items_per_order": args.items, "routes": {}}
+    for url in (f"/api/orders?limit={args.limit}", f"/api/items?limit={args.limit}"):
+        paths = {}
+        bodies = {}
+        for fast in (False, True):
+            APP.config["FAST_JSON"] = fast
+            client.get(url)  # warm up
+            name = "fast" if fast else "marshal"
+            paths[name], bodies[name] = timed_requests(client, url, args.requests)
+        paths["identical"] = bodies["fast"] == bodies["marshal"]
+        paths["speedup"] = round(paths["marshal"]["p50_ms"] / paths["fast"]["p50_ms"], 2)
+        results["routes"][url] = paths
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
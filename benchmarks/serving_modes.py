@@ -0,0 +1,117 @@
+"""
+Benchmark of the sync and the gevent serving modes of the Orders microservice
+
+Starts gunicorn with one worker once per WORKER_CLASS, keeps CONCURRENCY requests
+in flight against GET /api/orders/{id} and GET /api/orders, and prints the
+latency percentiles and throughput of every mode as JSON. The service uses the
+database in DATABASE_URI, which should be Postgres for the numbers to mean
+anything, and the order cache is disabled so every request reaches it.
+
+  python -m benchmarks.serving_modes --concurrency 200 --requests 4000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.stats import summarize
+
+MODES = ("sync", "gevent")
+
+
+def request(url, data=None):
+    """ Sends a request and returns the decoded JSON body """
+    body = json.dumps(data).encode("utf-8") if data is not None else None
+    req = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        return json.loads(resp.read() or "null")
+
+
+def start_server(mode, port):
+    """ Starts gunicorn with the given worker class and waits until it answers """
+    env = dict(os.environ, WORKER_CLASS=mode, CACHE_BACKEND="none")
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "-m", "gunicorn", "--workers=1",
+         f"--bind=127.0.0.1:{port}", "--log-level=warning", "run:APP"],
+        env=env)
+    for _ in range(100):
+        try:
+            request(f"http://127.0.0.1:{port}/api/orders?limit=1")
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"gunicorn did not start in {mode} mode")
+
+
+def seed(base_url, orders):
+    """ Creates the orders that the benchmark reads """
+    payload = [
+        {"customer_id": n % 50, "tracking_id": n, "status": "CREATED",
+         "items": [{"product_id": n, "quantity": 1, "price": 9.99}]}
+        for n in range(orders)
+    ]
+    results = request(f"{base_url}/api/orders/bulk", payload)
+    return [result["order"]["id"] for result in results]
+
+
+def run_load(base_url, order_ids, concurrency, requests):
+    """ Keeps concurrency requests in flight until all requests were sent """
+    urls = []
+    for n in range(requests):
+        if n % 2:
+            urls.append(f"{base_url}/api/orders?limit=20")
+        else:
+            urls.append(f"{base_url}/api/orders/{order_ids[n % len(order_ids)]}")
+
+    def timed(url):
+        start = time.perf_counter()
+        try:
+            request(url)
+        except (urllib.error.URLError, ConnectionError):
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        durations = list(executor.map(timed, urls))
+    elapsed = time.perf_counter() - start
+    latencies = [duration for duration in durations if duration is not None]
+    return summarize(latencies, elapsed, errors=len(durations) - len(latencies))
+
+
+def main():
+    """ Runs the benchmark in every serving mode """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    order_ids = None
+    results = {}
+    for mode in args.modes:
+        server = start_server(mode, args.port)
+        try:
+            if order_ids is None:
+                order_ids = seed(base_url, args.orders)
+            run_load(base_url, order_ids, args.concurrency, 50)  # warm up
+            results[mode] = run_load(base_url, order_ids,
+                                     args.concurrency, args.requests)
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps({"concurrency": args.concurrency, "modes": results},
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
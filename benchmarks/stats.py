@@ -0,0 +1,33 @@
+"""
+This module contains the statistics that the benchmarks report.
+"""
+import math
+
+
+def percentile(samples, pct):
+    """ Returns the nearest-rank percentile of a list of samples """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """
+    Summarizes the latencies of a run in milliseconds
+
+    Args:
+        latencies (list): the duration of every request in seconds
+        elapsed (float): the wall clock time of the whole run in seconds
+        errors (int): the number of requests that failed
+    """
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 3),
+    }
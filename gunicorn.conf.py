@@ -0,0 +1,46 @@
+"""
+Gunicorn settings for the Orders microservice, loaded automatically by gunicorn
+
+The worker class is chosen with the WORKER_CLASS environment variable:
+  sync   - the default, every worker serves one request at a time
+  gevent - every worker serves up to WORKER_CONNECTIONS requests at once,
+           switching between them whenever one waits on Postgres
+
+With gevent the database pool (DB_POOL_SIZE + DB_MAX_OVERFLOW) bounds how many
+requests can query Postgres at the same time, size it against max_connections
+
+The workers write their Prometheus samples to PROMETHEUS_MULTIPROC_DIR, which
+is emptied when gunicorn starts, so that /metrics reports all of them
+"""
+import os
+import shutil
+import tempfile
+
+worker_class = os.getenv("WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "500"))
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                      os.path.join(tempfile.gettempdir(), "orders-prometheus"))
+
+# imported once the directory is set, which decides how samples are stored
+from prometheus_client import multiprocess  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """ Removes the samples left behind by an earlier run """
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """ Makes psycopg2 cooperative in gevent workers """
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        patch_psycopg()
+        worker.log.info("Patched psycopg2 for gevent")
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """ Drops the live gauges of a worker that exited """
+    multiprocess.mark_process_dead(worker.pid)
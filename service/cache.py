@@ -0,0 +1,176 @@
+"""
+This module contains the cache of serialized Orders that is read before the database.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from service import APP
+
+
+class LRUCache():
+    """ In-process cache that evicts the least recently used entry when full """
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value stored under the key, or None if it is missing or expired """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Stores a value under the key until the TTL runs out """
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """ Removes the key from the cache """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every key from the cache """
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisCache():
+    """
+    Cache shared by every worker and kept in Redis
+
+    Any client with the get, setex and delete methods of redis.Redis can be used
+    """
+
+    def __init__(self, client, ttl=60, prefix="orders:cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """ Returns the value stored under the key, or None if it is missing or expired """
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def set(self, key, value):
+        """ Stores a value under the key until the TTL runs out """
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, key):
+        """ Removes the key from the cache """
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        """ Removes every key with our prefix from the cache """
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class NullCache():
+    """ Cache that never stores anything, used when caching is disabled """
+    # pylint: disable=unused-argument,no-self-use
+
+    def get(self, key):
+        """ Always misses """
+        return None
+
+    def set(self, key, value):
+        """ Discards the value """
+
+    def delete(self, key):
+        """ Nothing to remove """
+
+    def clear(self):
+        """ Nothing to remove """
+
+
+class OrderCache():
+    """ Serialized Orders keyed by their id, with hit and miss counters """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(order_id):
+        """ Returns the cache key of an Order id, or None if it is not an integer """
+        try:
+            return str(int(order_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, order_id):
+        """ Returns the cached payload of an Order or None on a miss """
+        key = self.key(order_id)
+        payload = self.backend.get(key) if key else None
+        if payload is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return payload
+
+    def set(self, order_id, payload):
+        """ Caches the serialized payload of an Order """
+        key = self.key(order_id)
+        if key:
+            self.backend.set(key, payload)
+
+    def invalidate(self, *order_ids):
+        """ Removes the payloads of the given Orders from the cache """
+        for order_id in order_ids:
+            key = self.key(order_id)
+            if key:
+                APP.logger.debug("Invalidating cached order %s", key)
+                self.backend.delete(key)
+
+    def clear(self):
+        """ Removes every payload from the cache """
+        self.backend.clear()
+
+    def stats(self):
+        """ Returns the hit and miss counters of the cache """
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def create_cache(config):
+    """ Creates the Order cache with the backend named by CACHE_BACKEND """
+    backend = config.get("CACHE_BACKEND", "memory")
+    ttl = config.get("CACHE_TTL", 60)
+    if backend == "memory":
+        return OrderCache(LRUCache(config.get("CACHE_MAXSIZE", 1024), ttl))
+    if backend == "redis":
+        import redis  # pylint: disable=import-outside-toplevel,import-error
+        client = redis.Redis.from_url(config["REDIS_URL"])
+        return OrderCache(RedisCache(client, ttl))
+    if backend == "none":
+        return OrderCache(NullCache())
+    raise ValueError(f"Unknown cache backend '{backend}'")
+
+
+order_cache = create_cache(APP.config)
@@ -0,0 +1,99 @@
+"""
+This module contains the change feed of the Orders and Items.
+"""
+from datetime import datetime, timedelta
+from service.database import db
+
+
+class Change(db.Model):
+    """
+    One entry of the change feed: an Order or Item was written or deleted
+
+    Every write appends an entry in the same transaction, so the seq of the
+    entries is a monotonic sequence that consumers can resume from
+    """
+    __tablename__ = "order_change"
+
+    seq = db.Column(db.Integer, primary_key=True)
+    record_type = db.Column(db.String(16), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    order_id = db.Column(db.Integer)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def record(cls, entries):
+        """
+        Appends entries to the change feed without committing
+
+        Args:
+            entries (list): dictionaries with the record_type, record_id,
+                order_id and deleted columns of every entry
+        """
+        if entries:
+            db.session.execute(cls.__table__.insert(), entries)
+
+    @classmethod
+    def since(cls, seq, limit, lag_seconds=0):
+        """
+        Returns the entries after a sequence number, oldest first
+
+        Entries younger than lag_seconds are held back, so that a transaction
+        which took a lower seq but commits a little later is usually not
+        skipped. The age is measured from changed_at, which every worker
+        stamps with its own clock, so this narrows the window but does not
+        close it
+
+        Args:
+            seq (int): the seq of the last entry already seen, or None
+            limit (int): the largest number of entries to return
+            lag_seconds (float): how old an entry must be to be returned
+        """
+        query = cls.query.order_by(cls.seq)
+        if seq is not None:
+            query = query.filter(cls.seq > seq)
+        if lag_seconds:
+            oldest = datetime.utcnow() - timedelta(seconds=lag_seconds)
+            query = query.filter(cls.changed_at <= oldest)
+        return query.limit(limit).all()
+
+    @classmethod
+    def feed(cls, seq, limit, models, lag_seconds=0):
+        """
+        Returns a page of the change feed and the current state of its records
+
+        Of the entries after seq only the latest one of every record is kept,
+        paired with the record as it is now, or with None when the record no
+        longer exists. Returns those pairs, oldest first, and the page of
+        entries they were taken from
+
+        Args:
+            seq (int): the seq of the last entry already seen, or None
+            limit (int): the largest number of entries to read
+            models (dict): the model of the records of every record_type
+            lag_seconds (float): how old an entry must be to be returned
+        """
+        page = cls.since(seq, limit, lag_seconds)
+        latest = {}
+        for change in page:
+            latest[key_of(change)] = change
+        records = {}
+        for record_type, model in models.items():
+            ids = {change.record_id for change in latest.values()
+                   if change.record_type == record_type}
+            if ids:
+                for record in model.base_query().filter(model.id.in_(ids)):
+                    records[(record_type, record.id)] = record
+        changes = sorted(latest.values(), key=lambda change: change.seq)
+        return [(change, records.get(key_of(change))) for change in changes], page
+
+
+def key_of(change):
+    """ Returns the record that a Change refers to as a (type, id) pair """
+    return (change.record_type, change.record_id)
+
+
+def change_entry(record_type, record_id, order_id, deleted=False):
+    """ Returns the Change.record() entry of one written or deleted record """
+    return {"record_type": record_type, "record_id": record_id,
+            "order_id": order_id, "deleted": deleted}
@@ -0,0 +1,7 @@
+"""
+This module contains the SQLAlchemy object that every database model is declared on.
+"""
+from flask_sqlalchemy import SQLAlchemy
+
+# Create the SQLAlchemy object to be initialized later in init_db()
+db = SQLAlchemy()
@@ -0,0 +1,120 @@
+"""
+This module contains the stored responses of requests sent with an Idempotency-Key header.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from service.cache import order_cache
+from service.database import db
+
+# Key of the session info under which the Orders changed by held writes wait
+HELD_ORDERS = "held_orders"
+
+
+class IdempotencyKey(db.Model):
+    """
+    The response to a request that was sent with an Idempotency-Key header
+
+    The row of a key is inserted before the request runs, so the unique
+    constraint lets exactly one of several concurrent requests with the same
+    key through without taking a lock. Its response is stored in the same
+    transaction as the writes of the request and replayed to every retry
+    until the row expires
+    """
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        db.UniqueConstraint('key', 'method', 'path', name='uq_idempotency_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)
+    method = db.Column(db.String(8), nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    # None while the first request with the key is still running
+    status_code = db.Column(db.Integer)
+    body = db.Column(db.Text)
+    location = db.Column(db.String(255))
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def claim(cls, scope, request_hash, seconds):
+        """
+        Claims a key for a request, or returns the request that claimed it
+
+        Returns the row of the key and True if this request inserted it. An
+        expired row is removed first, so its key can be claimed again
+
+        Args:
+            scope (dict): the value of the Idempotency-Key header as "key",
+                and the "method" and "path" of the request
+            request_hash (string): the digest of the body of the request
+            seconds (int): how long the claim holds if no response is stored
+        """
+        cls.query.filter_by(**scope).filter(
+            cls.expires_at < datetime.utcnow()).delete(synchronize_session="fetch")
+        record = cls(request_hash=request_hash,
+                     expires_at=datetime.utcnow() + timedelta(seconds=seconds), **scope)
+        db.session.add(record)
+        try:
+            db.session.commit()
+            return record, True
+        except IntegrityError:
+            db.session.rollback()
+        return cls.query.filter_by(**scope).first(), False
+
+    def hold_writes(self, seconds):
+        """
+        Makes the writes of the request commit together with its response
+
+        Refreshing the claim opens the transaction, and the writes run in a
+        SAVEPOINT inside it, whose commit only releases the savepoint. So
+        save_response() commits the writes along with the stored response and
+        release() rolls them back, and a request that dies in between leaves
+        neither behind: its retry runs again once the claim expires. The
+        cached Orders it changes are held back until then, see invalidate_orders()
+
+        Args:
+            seconds (int): how long the claim holds if no response is stored
+        """
+        self.expires_at = datetime.utcnow() + timedelta(seconds=seconds)
+        db.session.flush()
+        db.session.begin_nested()
+        db.session().info[HELD_ORDERS] = set()
+
+    def save_response(self, status_code, body, location, seconds):
+        """ Stores the response of the request, to be replayed for seconds """
+        self.status_code = status_code
+        self.body = body
+        self.location = location
+        self.expires_at = datetime.utcnow() + timedelta(seconds=seconds)
+        db.session.commit()
+        order_cache.invalidate(*db.session().info.pop(HELD_ORDERS, ()))
+
+    def release(self):
+        """ Removes the claim of a request that failed, so it can be retried """
+        db.session().info.pop(HELD_ORDERS, None)
+        db.session.rollback()
+        db.session.delete(self)
+        db.session.commit()
+
+    @classmethod
+    def purge_expired(cls):
+        """ Removes every expired key with one DELETE, returns how many there were """
+        count = cls.query.filter(cls.expires_at < datetime.utcnow()).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+def invalidate_orders(order_ids):
+    """
+    Drops the Orders that a committed write changed from the cache
+
+    While IdempotencyKey.hold_writes() holds the writes of a request, they are
+    dropped once those writes are really committed with its response instead
+    """
+    held = db.session().info.get(HELD_ORDERS)
+    if held is None:
+        order_cache.invalidate(*order_ids)
+    else:
+        held.update(order_ids)
@@ -0,0 +1,142 @@
+"""
+This module contains the opt-in timing of requests, their SQL queries and serialization.
+
+When REQUEST_TIMING is enabled every response carries a Server-Timing header
+and a structured log line with the number of queries, the time spent in the
+database, the time spent serializing and the total time of the request.
+Queries slower than SLOW_QUERY_MS are logged with their SQL.
+"""
+import json
+import time
+from functools import wraps
+from flask import g, has_request_context, request
+from flask_restx.representations import output_json
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service import APP
+
+
+class RequestTiming():
+    """ The time a request spent in its phases """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.serializing = False
+
+    def server_timing(self, total_seconds):
+        """ Returns the value of the Server-Timing header """
+        app_seconds = total_seconds - self.db_seconds - self.serialize_seconds
+        return ", ".join([
+            f'db;dur={self.db_seconds * 1000:.2f};desc="{self.queries} queries"',
+            f"serialize;dur={self.serialize_seconds * 1000:.2f}",
+            f"app;dur={max(app_seconds, 0) * 1000:.2f}",
+            f"total;dur={total_seconds * 1000:.2f}",
+        ])
+
+    def summary(self, total_seconds):
+        """ Returns the figures of the request that are logged """
+        return {
+            "queries": self.queries,
+            "db_ms": round(self.db_seconds * 1000, 3),
+            "serialize_ms": round(self.serialize_seconds * 1000, 3),
+            "total_ms": round(total_seconds * 1000, 3),
+        }
+
+
+def current_timing():
+    """ Returns the timing of the current request, or None when it is not timed """
+    if not has_request_context():
+        return None
+    return g.get("request_timing")
+
+
+def timed_serialization(function):
+    """
+    Adds the time spent in the decorated function to the serialize phase
+
+    Only the functions that serialize a whole response are decorated, since
+    even the check for a timed request costs more than serializing one record
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not APP.config["REQUEST_TIMING"]:
+            return function(*args, **kwargs)
+        timing = current_timing()
+        if timing is None or timing.serializing:
+            return function(*args, **kwargs)
+        timing.serializing = True
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timing.serialize_seconds += time.perf_counter() - start
+            timing.serializing = False
+    return wrapper
+
+
+######################################################################
+#  H O O K S
+######################################################################
+
+
+def before_cursor_execute(conn, *args):  # pylint: disable=unused-argument
+    """ Remembers when a query started """
+    if APP.config["REQUEST_TIMING"]:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, *args):
+    # pylint: disable=unused-argument
+    """ Adds a finished query to the request and logs it if it was slow """
+    if not APP.config["REQUEST_TIMING"] or not conn.info.get("query_start"):
+        return
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    timing = current_timing()
+    if timing is not None:
+        timing.queries += 1
+        timing.db_seconds += elapsed
+    if elapsed * 1000 >= APP.config["SLOW_QUERY_MS"]:
+        APP.logger.warning("Slow query took %.1f ms: %s %s",
+                           elapsed * 1000, statement, parameters)
+
+
+def start_request_timing():
+    """ Starts timing a request """
+    if APP.config["REQUEST_TIMING"]:
+        g.request_timing = RequestTiming()
+
+
+def finish_request_timing(response):
+    """ Adds the timing of the request to the response and the log """
+    timing = g.pop("request_timing", None)
+    if timing is None:
+        return response
+    total_seconds = time.perf_counter() - timing.start
+    response.headers["Server-Timing"] = timing.server_timing(total_seconds)
+    APP.logger.info(json.dumps({
+        "event": "request_timing",
+        "method": request.method,
+        "path": request.path,
+        "status": response.status_code,
+        **timing.summary(total_seconds),
+    }))
+    return response
+
+
+@timed_serialization
+def timed_output_json(data, code, headers=None):
+    """ Encodes a response as JSON while timing it as serialization """
+    return output_json(data, code, headers)
+
+
+def install(app, api):
+    """ Registers the timing hooks with Flask, Flask-RESTX and SQLAlchemy """
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        app.before_request(start_request_timing)
+        app.after_request(finish_request_timing)
+        api.representations["application/json"] = timed_output_json
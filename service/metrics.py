@@ -0,0 +1,148 @@
+"""
+This module contains the Prometheus metrics of the Orders microservice.
+
+Request metrics are recorded by request hooks and cost a few microseconds per
+request, and every worker refreshes the pool gauges at most once a second
+after one of its requests. The pool counts its checkouts itself, see
+service.pool. When PROMETHEUS_MULTIPROC_DIR is set every gunicorn worker writes its
+samples to that directory and a scrape of any worker collects all of them.
+The order counts are read from the database at scrape time.
+"""
+import os
+import time
+from flask import g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from service import queries
+from service.models import db
+from service.pool import pool_monitor
+
+REQUESTS = Counter(
+    "orders_http_requests_total", "HTTP requests served",
+    ["method", "route", "status"])
+REQUEST_LATENCY = Histogram(
+    "orders_http_request_duration_seconds", "Time taken to serve a request",
+    ["method", "route", "status"])
+REQUESTS_IN_PROGRESS = Gauge(
+    "orders_http_requests_in_progress", "HTTP requests being served",
+    multiprocess_mode="livesum")
+POOL_CONNECTIONS = Gauge(
+    "orders_db_pool_connections", "Connections of the database pool",
+    ["state"], multiprocess_mode="livesum")
+POOL_SATURATION = Gauge(
+    "orders_db_pool_saturation", "Share of the database pool that is checked out",
+    multiprocess_mode="liveall")
+
+# Seconds between two refreshes of the pool gauges by the same worker
+POOL_REFRESH_SECONDS = 1.0
+
+
+class OrderStatusCollector():  # pylint: disable=too-few-public-methods
+    """ Reports the number of Orders in every status when scraped """
+
+    def __init__(self, count_by_status):
+        self.count_by_status = count_by_status
+
+    def collect(self):
+        """ Yields the order counts read from the database """
+        metric = GaugeMetricFamily(
+            "orders_by_status", "Orders in every status", labels=["status"])
+        for order_status, count in self.count_by_status().items():
+            metric.add_metric([order_status], count)
+        yield metric
+
+
+######################################################################
+#  H O O K S
+######################################################################
+
+
+class RouteMetrics():
+    """ The request counter and latency histogram of every route and status """
+
+    def __init__(self):
+        self.children = {}
+        self.pool_refreshed = 0.0
+
+    def record(self, labels, seconds):
+        """ Counts a request and its latency, looking up the labels only once """
+        children = self.children.get(labels)
+        if children is None:
+            children = (REQUESTS.labels(*labels), REQUEST_LATENCY.labels(*labels))
+            self.children[labels] = children
+        children[0].inc()
+        children[1].observe(seconds)
+
+    def refresh_pool(self, now):
+        """ Returns True if the pool gauges are due for a refresh """
+        if now - self.pool_refreshed < POOL_REFRESH_SECONDS:
+            return False
+        self.pool_refreshed = now
+        return True
+
+
+route_metrics = RouteMetrics()
+
+
+def start_request():
+    """ Counts the request as in progress """
+    g.metrics_start = time.perf_counter()
+    REQUESTS_IN_PROGRESS.inc()
+
+
+def finish_request(response):
+    """ Records the latency of the request under its route template """
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+    rule = request.url_rule
+    route = rule.rule if rule else "unmatched"
+    labels = (request.method, route, str(response.status_code))
+    route_metrics.record(labels, time.perf_counter() - start)
+    return response
+
+
+def end_request(exception=None):  # pylint: disable=unused-argument
+    """ Counts the request as finished, even when it failed """
+    if g.pop("metrics_start", None) is not None:
+        REQUESTS_IN_PROGRESS.dec()
+        if route_metrics.refresh_pool(time.monotonic()):
+            update_pool_metrics(db.engine.pool)
+
+
+def update_pool_metrics(pool):
+    """ Copies the state of the database pool into the pool gauges """
+    stats = pool_monitor.stats(pool)
+    for state in ("checked_in", "checked_out", "overflow"):
+        if state in stats:
+            POOL_CONNECTIONS.labels(state).set(stats[state])
+    if "saturation" in stats:
+        POOL_SATURATION.set(stats["saturation"])
+
+
+######################################################################
+#  E X P O S I T I O N
+######################################################################
+
+
+def render():
+    """ Returns the body and content type of a scrape """
+    update_pool_metrics(db.engine.pool)
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    orders = CollectorRegistry()
+    orders.register(OrderStatusCollector(queries.count_by_status))
+    return generate_latest(registry) + generate_latest(orders), CONTENT_TYPE_LATEST
+
+
+def install(app):
+    """ Registers the request hooks with Flask """
+    if start_request not in app.before_request_funcs.get(None, []):
+        app.before_request(start_request)
+        app.after_request(finish_request)
+        app.teardown_request(end_request)
@@ -2,12 +2,19 @@
 This module contains the database models for order and item resources.
 """
 
+import hashlib
+import json
+from datetime import datetime
 from enum import Enum
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, exists, func, inspect, literal, select, tuple_
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import column_property, joinedload, load_only, noload, selectinload
+from sqlalchemy.orm.util import identity_key
 from service import APP
-
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+from service.changes import Change, change_entry
+from service.database import db
+from service.idempotency import invalidate_orders
+from service.pool import engine_options
 
 
 class DatabaseConnectionError(Exception):
@@ -31,8 +38,89 @@ class OrderStatus(Enum):
     CANCELLED = 3
 
 
+# The statuses that an Order may move to, each with the statuses it may leave
+ORDER_TRANSITIONS = {
+    OrderStatus.PAID: (OrderStatus.CREATED,),
+    OrderStatus.COMPLETED: (OrderStatus.PAID,),
+    OrderStatus.CANCELLED: (OrderStatus.CREATED, OrderStatus.PAID),
+}
+
+# Loader options used to fetch the items of an order along with the order
+ITEMS_LOADING_STRATEGIES = {
+    "selectin": selectinload,
+    "joined": joinedload,
+}
+
+# Indexes that earlier versions created and that an index on (column, id)
+# has replaced, by table. upgrade_db drops them so that writes stop paying
+# for them
+REPLACED_INDEXES = {
+    "order": ("ix_order_status", "ix_order_total_amount", "ix_order_item_count"),
+}
+
+
+def model_name(record):
+    """ Returns the model of an object or of a read-only record of one """
+    return getattr(record, "model_name", type(record).__name__)
+
+
+def typed_value(data, name, types, model, nullable=False):
+    """
+    Returns a value of the data after checking that it is one of the types
+
+    A null or ill-typed value would otherwise only be rejected by a constraint
+    of the database when the record is written
+    """
+    value = data[name]
+    if value is None and nullable:
+        return value
+    if isinstance(value, bool) or not isinstance(value, types):
+        raise DataValidationError(
+            f"Invalid {model}: {name} must be a number, not {json.dumps(value)}")
+    return value
+
+
+def etag_of(records, variant=None):
+    """
+    Returns an entity tag that changes whenever one of the records changes
+
+    The tag is derived from the id and version of every record, so it can be
+    computed without serializing the records. A variant, such as the fields
+    of a partial response, gives every representation of them its own tag
+    """
+    versions = sorted(f"{model_name(record)}:{record.id}:{record.version}"
+                      for record in records)
+    if variant is not None:
+        versions.append(variant)
+    return hashlib.sha1(",".join(versions).encode("utf-8")).hexdigest()
+
+
+def keyset_value(column, value):
+    """ Converts the sort key read from a cursor into a value of the column """
+    try:
+        if isinstance(column.type, db.Enum):
+            return column.type.enum_class[value]
+        return column.type.python_type(value)
+    except (KeyError, TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid cursor value '{value}'") from error
+
+
+def totals_of(items):
+    """ Returns the total amount and the number of the items """
+    return sum(item.price * item.quantity for item in items), len(items)
+
+
+def add_total(changes, order_id, amount, count):
+    """ Adds a change to the totals of an Order to the changes of a write """
+    if order_id is not None:
+        total = changes.get(order_id, (0, 0))
+        changes[order_id] = (total[0] + amount, total[1] + count)
+
+
 class PersistentBase():
     """ Base class added persistent methods """
+    # the primary key column, which every model declares
+    id = None  # pylint: disable=invalid-name
 
     def __init__(self):
         self.id = None  # pylint: disable=invalid-name
@@ -42,60 +130,256 @@ class PersistentBase():
         Creates an Order or Item to the database
         """
         self.id = None  # id must be none to generate next primary key
+        cached_orders = self.cached_orders()
+        totals = self.total_changes()
         db.session.add(self)
+        db.session.flush()  # assigns the ids that the change feed refers to
+        update_totals(totals)
+        Change.record(self.change_entries(cascade=True))
         db.session.commit()
+        invalidate_orders(cached_orders)
 
     def update(self):
         """
         Updates an Order or Item to the database
         """
         APP.logger.debug("Updating %s", self.id)
+        cached_orders = self.cached_orders()
+        totals = self.total_changes()
+        db.session.flush()
+        update_totals(totals)
+        Change.record(self.change_entries())
         db.session.commit()
+        invalidate_orders(cached_orders)
 
     def delete(self):
         """ Removes an Order or Item from the database """
         APP.logger.debug("Deleting %s", self.id)
+        cached_orders = self.cached_orders()
+        totals = self.total_changes(deleted=True)
+        Change.record(self.change_entries(deleted=True, cascade=True))
         db.session.delete(self)
+        db.session.flush()
+        update_totals(totals)
         db.session.commit()
+        invalidate_orders(cached_orders)
+
+    def cached_orders(self):
+        """ Returns the ids of the cached Orders that a write to this record changes """
+        raise NotImplementedError
+
+    def total_changes(self, deleted=False):
+        """
+        Returns what a write to this record adds to the totals of Orders
+
+        The changes are {order_id: (amount, count)} and are read before the
+        write, while the values that the record had are still known
+
+        Args:
+            deleted (bool): True if the record is deleted
+        """
+        raise NotImplementedError
+
+    def change_entries(self, deleted=False, cascade=False):
+        """
+        Returns the change feed entries of a write to this record
+
+        Args:
+            deleted (bool): True if the record is deleted
+            cascade (bool): True if the records it owns are written with it
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def insert_rows(cls, rows):
+        """
+        Inserts rows into the table of this class without committing
+
+        On databases that support RETURNING all rows go out in one multi-row
+        INSERT, otherwise one INSERT is issued per row. The ids of the new rows
+        are returned in the same order as the rows
+
+        Args:
+            rows (list): a dictionary of column values for every new row
+        """
+        if not rows:
+            return []
+        table = cls.__table__  # pylint: disable=no-member
+        if db.session.get_bind().dialect.implicit_returning:  # pylint: disable=no-member
+            result = db.session.execute(
+                table.insert().values(rows).returning(table.c.id))
+            # ids come from a sequence, so they increase in VALUES order
+            return sorted(row[0] for row in result)
+        return [
+            db.session.execute(  # pylint: disable=no-member
+                table.insert().values(row)).inserted_primary_key[0]
+            for row in rows
+        ]
 
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         APP.logger.debug("Initializing database")
         cls.APP = app
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+            app.config["SQLALCHEMY_DATABASE_URI"],
+            app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        cls.upgrade_db()
+
+    @classmethod
+    def upgrade_db(cls):
+        """
+        Brings the tables of an existing database up to date with the models
+
+        create_all() only creates missing tables, so the columns and indexes
+        that were added to tables which already exist are created here, and
+        the indexes in REPLACED_INDEXES are dropped. New columns must be
+        nullable or have a server default to be added this way. The totals of
+        the Orders are computed once when their columns are added
+        """
+        inspector = inspect(db.engine)
+        dialect = db.engine.dialect
+        tables = set(inspector.get_table_names())
+        added = set()
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {column["name"]
+                        for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    APP.logger.info("Adding column %s.%s",
+                                    table.name, column.name)
+                    table_name = dialect.identifier_preparer.format_table(table)
+                    column_ddl = dialect.ddl_compiler(dialect, CreateColumn(column)).string
+                    db.engine.execute(
+                        f"ALTER TABLE {table_name} ADD COLUMN {column_ddl}")
+                    added.add((table.name, column.name))
+            existing = {index["name"]
+                        for index in inspector.get_indexes(table.name)}
+            for name in REPLACED_INDEXES.get(table.name, ()):
+                if name in existing:
+                    APP.logger.info("Dropping index %s", name)
+                    db.engine.execute(
+                        f"DROP INDEX {dialect.identifier_preparer.quote(name)}")
+            for index in table.indexes:
+                if index.name not in existing:
+                    APP.logger.info("Creating index %s", index.name)
+                    index.create(bind=db.engine)
+        if ("order", "total_amount") in added and "item" in tables:
+            recompute_totals()
 
     @classmethod
-    def all(cls):
+    def base_query(cls):
+        """ Returns the query that all lookups of this class start from """
+        return cls.query  # pylint: disable=no-member
+
+    @classmethod
+    def sortable_columns(cls):
+        """
+        Returns the names of the columns that lists can be sorted by
+
+        Those are the id and every column that cannot be NULL and leads an
+        index on (column, id), which serves the ORDER BY and the keyset of
+        every page, so no sort has to read the whole table
+        """
+        names = {"id"}
+        for index in cls.__table__.indexes:  # pylint: disable=no-member
+            columns = list(index.columns)
+            if len(columns) == 2 and columns[1].name == "id" and not columns[0].nullable:
+                names.add(columns[0].name)
+        return names
+
+    @classmethod
+    def paginate(cls, query, limit=None, after=None, sort=None):
+        """
+        Returns one page of a query using the sort key and the id as the keyset
+
+        Args:
+            query (Query): the query to take the page from
+            limit (int): the largest number of records to return
+            after: only records after this one are returned, given by its id,
+                or by its (sort key, id) when sorted by another column
+            sort (tuple): the name of a sortable column and True to sort it in
+                descending order, or None to sort by id
+        """
+        if sort is None:
+            if limit is None and after is None:
+                return query.all()
+            sort = ("id", False)
+        name, descending = sort
+        if name not in cls.sortable_columns():
+            raise DataValidationError(f"Cannot sort by '{name}'")
+        column = getattr(cls, name)
+        keys = [cls.id] if name == "id" else [column, cls.id]
+        query = query.order_by(*[key.desc() if descending else key for key in keys])
+        if after is not None:
+            if name == "id":
+                position, bound = cls.id, after
+            else:
+                position = tuple_(column, cls.id)
+                bound = tuple_(literal(keyset_value(column, after[0]), column.type), after[1])
+            query = query.filter(position < bound if descending else position > bound)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @classmethod
+    def all(cls, limit=None, after=None):
         """ Returns all of the records in the database """
         APP.logger.debug("Processing all records")
-        return cls.query.all()  # pylint: disable=no-member
+        return cls.paginate(cls.base_query(), limit, after)
+
+    @classmethod
+    def load_columns(cls, columns):
+        """
+        Returns the loader option that reads only the given columns
+
+        The id and version are always read, so the records still have an ETag
+        """
+        return load_only(*dict.fromkeys(("id", "version", *columns)))
 
     @classmethod
     def find(cls, by_id):
         """ Finds a record by it's ID """
         APP.logger.debug("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)  # pylint: disable=no-member
+        return cls.base_query().get(by_id)
 
     @classmethod
     def find_or_404(cls, by_id):
         """ Find a record by it's id """
         APP.logger.debug("Processing lookup or 404 for id %s ...", by_id)
-        return cls.query.get_or_404(by_id)  # pylint: disable=no-member
+        return cls.base_query().get_or_404(by_id)
 
 
 class Item(db.Model, PersistentBase):
     """ Class that represents an Item """
     APP = None
+    # the items of a product in the order of their ids, and the orders that
+    # contain a product read from the index alone
+    __table_args__ = (
+        db.Index('ix_item_product_id_id', 'product_id', 'id'),
+        db.Index('ix_item_product_id_order_id', 'product_id', 'order_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, nullable=False)
-    quantity = db.Column(db.Integer, nullable=False, default=1)
-    price = db.Column(db.Float, nullable=False)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    # the old values are loaded when these are changed, to correct the totals
+    quantity = column_property(db.Column(db.Integer, nullable=False, default=1),
+                               active_history=True)
+    price = column_property(db.Column(db.Float, nullable=False), active_history=True)
+    order_id = column_property(db.Column(db.Integer, db.ForeignKey('order.id'), index=True),
+                               active_history=True)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # every UPDATE bumps the version and fails if the row was changed meanwhile
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -110,6 +394,130 @@ class Item(db.Model, PersistentBase):
         if "order_id" in kwargs:
             self.order_id = kwargs["order_id"]
 
+    def etag(self):
+        """ Returns the entity tag of the Item """
+        return etag_of([self])
+
+    def cached_orders(self):
+        """ Returns the Order the Item belongs to, and the one it was moved from """
+        history = inspect(self).attrs.order_id.history
+        return {self.order_id, *history.deleted} - {None}
+
+    def total_changes(self, deleted=False):
+        """ Takes the old price and quantity of the Item off its old Order and adds the new """
+        changes = {}
+        state = inspect(self)
+        if state.persistent:
+            old = [state.committed_state.get(name, getattr(self, name))
+                   for name in ("order_id", "price", "quantity")]
+            add_total(changes, old[0], -old[1] * old[2], -1)
+        if not deleted:
+            add_total(changes, self.order_id, self.price * self.quantity, 1)
+        return {order_id: total for order_id, total in changes.items()
+                if total != (0, 0)}
+
+    def change_entries(self, deleted=False, cascade=False):
+        """ Returns the change feed entry of the Item """
+        return [change_entry("item", self.id, self.order_id, deleted)]
+
+    @classmethod
+    def find_in_order(cls, order_id, item_id, columns=None):
+        """Finds an Item by its id, but only if it belongs to the Order
+
+        Args:
+            order_id (int): the id of the Order the Item must belong to
+            item_id (int): the id of the Item
+            columns (list): the only columns to read, or None for all of them
+        """
+        APP.logger.debug("Processing lookup for item %s of order %s ...", item_id, order_id)
+        query = cls.query.filter(cls.id == item_id, cls.order_id == order_id)
+        if columns is not None:
+            query = query.options(cls.load_columns(columns))
+        return query.first()
+
+    @classmethod
+    def find_by_order(cls, order_id, columns=None):
+        """Returns the Items of an Order without loading the Order
+
+        Args:
+            order_id (int): the id of the Order
+            columns (list): the only columns to read, or None for all of them
+        """
+        APP.logger.debug("Processing lookup for items of order %s ...", order_id)
+        query = cls.query.filter(cls.order_id == order_id).order_by(cls.id)
+        if columns is not None:
+            query = query.options(cls.load_columns(columns))
+        return query.all()
+
+    @classmethod
+    def filter_criteria(cls, filters):
+        """Returns the SQL criteria that select the Items matching the filters
+
+        Filters that are missing or None are left out, all others are meant to
+        be combined with AND in the WHERE clause of a single query
+
+        Args:
+            filters (dict): any of these filters
+                product_id (int): the product of the Items
+                min_price (float): the smallest price of the Items
+                max_price (float): the largest price of the Items
+                min_quantity (int): the smallest quantity of the Items
+                max_quantity (int): the largest quantity of the Items
+        """
+        criteria = []
+        if filters.get("product_id") is not None:
+            criteria.append(cls.product_id == filters["product_id"])
+        if filters.get("min_price") is not None:
+            criteria.append(cls.price >= filters["min_price"])
+        if filters.get("max_price") is not None:
+            criteria.append(cls.price <= filters["max_price"])
+        if filters.get("min_quantity") is not None:
+            criteria.append(cls.quantity >= filters["min_quantity"])
+        if filters.get("max_quantity") is not None:
+            criteria.append(cls.quantity <= filters["max_quantity"])
+        return criteria
+
+    @classmethod
+    def filtered_query(cls, **filters):
+        """Returns a query for the Items that match every given filter
+
+        Args:
+            filters: the filters accepted by filter_criteria()
+        """
+        return cls.base_query().filter(*cls.filter_criteria(filters))
+
+    @classmethod
+    def create_many(cls, order_id, items):
+        """
+        Adds many Items to an Order in a single transaction
+
+        The Items are inserted with batched INSERTs and read back with one query
+
+        Args:
+            order_id (int): the Order the Items are added to
+            items (list): the deserialized Items to create
+        """
+        APP.logger.debug("Adding %d items to order %s", len(items), order_id)
+        try:
+            item_ids = cls.insert_rows([
+                {
+                    "product_id": item.product_id,
+                    "quantity": item.quantity,
+                    "price": item.price,
+                    "order_id": order_id,
+                }
+                for item in items
+            ])
+            update_totals([order_id])
+            Change.record([change_entry("item", item_id, order_id) for item_id in item_ids])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        invalidate_orders([order_id])
+        created = cls.query.filter(cls.id.in_(item_ids)).all()  # pylint: disable=no-member
+        return sorted(created, key=lambda item: item.id)
+
     def __repr__(self):
         return f"Item('{self.id}', '{self.product_id}', '{self.quantity}', '{self.price}', '{self.order_id}')"    # pylint: disable=line-too-long
 
@@ -133,9 +541,9 @@ class Item(db.Model, PersistentBase):
             if "id" in data:
                 self.id = data["id"]
 
-            self.product_id = data["product_id"]
-            self.quantity = data["quantity"]
-            self.price = data["price"]
+            self.product_id = typed_value(data, "product_id", int, "Item")
+            self.quantity = typed_value(data, "quantity", int, "Item")
+            self.price = typed_value(data, "price", (int, float), "Item")
 
             if "order_id" in data:
                 self.order_id = data["order_id"]
@@ -158,15 +566,35 @@ class Order(db.Model, PersistentBase):
     This class contains the database schema for Order objects
     """
     APP = None
+    # the composite index also serves lookups on customer_id alone, and the
+    # indexes that end in id serve the sort keys of the lists of Orders
+    __table_args__ = (
+        db.Index('ix_order_customer_id_status', 'customer_id', 'status'),
+        db.Index('ix_order_customer_id_id', 'customer_id', 'id'),
+        db.Index('ix_order_status_id', 'status', 'id'),
+        db.Index('ix_order_total_amount_id', 'total_amount', 'id'),
+        db.Index('ix_order_item_count_id', 'item_count', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, nullable=False)
     tracking_id = db.Column(db.Integer)
     status = db.Column(
         db.Enum(OrderStatus), nullable=False, server_default=(OrderStatus.CREATED.name)
     )
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # sum of price * quantity and number of the items, kept up to date by
+    # every write to them so that nothing has to read the items to know them
+    total_amount = db.Column(db.Float, nullable=False, server_default="0")
+    item_count = db.Column(db.Integer, nullable=False, server_default="0")
     items = db.relationship(
         'Item', backref='order', cascade="all, delete", lazy=True)
 
+    # every UPDATE bumps the version and fails if the row was changed meanwhile
+    __mapper_args__ = {"version_id_col": version}
+
     def __init__(self, **kwargs):
         super().__init__()
         if "id" in kwargs:
@@ -180,6 +608,37 @@ class Order(db.Model, PersistentBase):
         if "items" in kwargs:
             self.items = kwargs["items"]
 
+    def etag(self):
+        """ Returns the entity tag of the Order, which also covers its items """
+        return etag_of([self, *self.items])
+
+    def cached_orders(self):
+        """ Returns the id of the Order itself """
+        return {self.id} - {None}
+
+    def total_changes(self, deleted=False):
+        """
+        Recomputes the totals of the Order from its items when they are loaded
+
+        The items of an Order are only added or changed through the Order
+        when they are loaded, so no other Order is changed
+        """
+        state = inspect(self)
+        if not deleted and (state.transient or "items" not in state.unloaded):
+            self.total_amount, self.item_count = totals_of(self.items)
+        return {}
+
+    def change_entries(self, deleted=False, cascade=False):
+        """
+        Returns the change feed entries of the Order, and of its items when
+        they are created or deleted with it
+        """
+        entries = [change_entry("order", self.id, self.id, deleted)]
+        if cascade:
+            entries.extend(change_entry("item", item.id, self.id, deleted)
+                           for item in self.items)
+        return entries
+
     def __repr__(self):
         return f"Order('{self.id}', '{self.customer_id}', '{self.tracking_id}', '{self.status}')"
 
@@ -194,6 +653,8 @@ class Order(db.Model, PersistentBase):
             "customer_id": self.customer_id,
             "tracking_id": self.tracking_id,
             "status": self.status.name,
+            "total_amount": self.total_amount,
+            "item_count": self.item_count,
             "items": items,
         }
 
@@ -207,8 +668,8 @@ class Order(db.Model, PersistentBase):
             if "id" in data:
                 self.id = data["id"]
 
-            self.customer_id = data["customer_id"]
-            self.tracking_id = data["tracking_id"]
+            self.customer_id = typed_value(data, "customer_id", int, "Order")
+            self.tracking_id = typed_value(data, "tracking_id", int, "Order", nullable=True)
 
             if "items" in data:
                 self.items = []
@@ -228,21 +689,280 @@ class Order(db.Model, PersistentBase):
         return self
 
     @classmethod
-    def find_by_status(cls, status):
+    def base_query(cls):
+        """
+        Returns a query that loads the items of every Order it returns
+
+        The items are fetched with the strategy named by ORDER_ITEMS_LOADING
+        so that serializing a list of Orders does not issue one query per Order
+        """
+        strategy = APP.config.get("ORDER_ITEMS_LOADING", "selectin")
+        if strategy not in ITEMS_LOADING_STRATEGIES:
+            raise ValueError(f"Unknown items loading strategy '{strategy}'")
+        loader = ITEMS_LOADING_STRATEGIES[strategy]
+        return cls.query.options(loader(cls.items))  # pylint: disable=no-member
+
+    @classmethod
+    def create_many(cls, orders):
+        """
+        Creates many Orders and their items in a single transaction
+
+        The Orders are inserted with batched INSERTs and all of their items
+        with one executemany, then the new Orders are read back with one query
+
+        Args:
+            orders (list): the deserialized Orders to create
+        """
+        APP.logger.debug("Creating %d orders", len(orders))
+        try:
+            order_ids = cls.insert_rows([
+                {
+                    "customer_id": order.customer_id,
+                    "tracking_id": order.tracking_id,
+                    "status": order.status,
+                    "total_amount": totals_of(order.items)[0],
+                    "item_count": len(order.items),
+                }
+                for order in orders
+            ])
+            item_rows = [
+                {
+                    "product_id": item.product_id,
+                    "quantity": item.quantity,
+                    "price": item.price,
+                    "order_id": order_id,
+                }
+                for order, order_id in zip(orders, order_ids)
+                for item in order.items
+            ]
+            if item_rows:
+                db.session.execute(
+                    Item.__table__.insert(), item_rows)  # pylint: disable=no-member
+            entries = [change_entry("order", order_id, order_id) for order_id in order_ids]
+            if item_rows:
+                created_items = db.session.query(Item.id, Item.order_id).filter(  # pylint: disable=no-member
+                    Item.order_id.in_(order_ids)).order_by(Item.id)
+                entries.extend(change_entry("item", item_id, order_id)
+                               for item_id, order_id in created_items)
+            Change.record(entries)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        created = cls.base_query().filter(cls.id.in_(order_ids)).all()  # pylint: disable=no-member
+        return sorted(created, key=lambda order: order.id)
+
+    @classmethod
+    def filter_criteria(cls, filters):
+        """Returns the SQL criteria that select the Orders matching the filters
+
+        Filters that are missing or None are left out, all others are meant to
+        be combined with AND in the WHERE clause of a single query
+
+        Args:
+            filters (dict): any of these filters
+                statuses (list): the OrderStatus values the Orders may be in
+                customer_id (int): the id of the Customer you want to match
+                tracking_id (int): the tracking id you want to match
+                min_id (int): the smallest Order id to return
+                max_id (int): the largest Order id to return
+                min_total (float): the smallest total amount of the Orders
+                max_total (float): the largest total amount of the Orders
+                min_items (int): the smallest number of items of the Orders
+                max_items (int): the largest number of items of the Orders
+                product_id (int): a product that the Orders contain
+        """
+        criteria = []
+        if filters.get("statuses") is not None:
+            criteria.append(cls.status.in_(filters["statuses"]))  # pylint: disable=no-member
+        if filters.get("customer_id") is not None:
+            criteria.append(cls.customer_id == filters["customer_id"])
+        if filters.get("tracking_id") is not None:
+            criteria.append(cls.tracking_id == filters["tracking_id"])
+        if filters.get("min_id") is not None:
+            criteria.append(cls.id >= filters["min_id"])
+        if filters.get("max_id") is not None:
+            criteria.append(cls.id <= filters["max_id"])
+        if filters.get("min_total") is not None:
+            criteria.append(cls.total_amount >= filters["min_total"])
+        if filters.get("max_total") is not None:
+            criteria.append(cls.total_amount <= filters["max_total"])
+        if filters.get("min_items") is not None:
+            criteria.append(cls.item_count >= filters["min_items"])
+        if filters.get("max_items") is not None:
+            criteria.append(cls.item_count <= filters["max_items"])
+        if filters.get("product_id") is not None:
+            criteria.append(cls.id.in_(  # pylint: disable=no-member
+                select([Item.order_id]).where(Item.product_id == filters["product_id"])))
+        return criteria
+
+    @classmethod
+    def filtered_query(cls, **filters):
+        """Returns a query for the Orders that match every given filter
+
+        Args:
+            filters: the filters accepted by filter_criteria()
+        """
+        return cls.base_query().filter(*cls.filter_criteria(filters))
+
+    @classmethod
+    def find_projected(cls, order_id, columns, item_columns=None):
+        """Finds an Order by its id, reading only the given columns
+
+        Args:
+            order_id (int): the id of the Order
+            columns (list): the only columns of the Order to read
+            item_columns (list): the only columns of its Items, None for no Items
+        """
+        APP.logger.debug("Processing projected lookup for id %s ...", order_id)
+        if item_columns is None:
+            items = noload(cls.items)
+        else:
+            strategy = ITEMS_LOADING_STRATEGIES[APP.config.get("ORDER_ITEMS_LOADING", "selectin")]
+            items = strategy(cls.items).load_only(
+                *dict.fromkeys(("id", "order_id", "version", *item_columns)))
+        query = cls.query.options(cls.load_columns(columns), items)  # pylint: disable=no-member
+        return query.filter(cls.id == order_id).first()
+
+    @classmethod
+    def exists(cls, order_id):
+        """Returns True if there is an Order with the id, without loading it"""
+        return db.session.query(exists().where(cls.id == order_id)).scalar()  # pylint: disable=no-member
+
+    @classmethod
+    def committed_version(cls, order_id):
+        """Returns the version of the Order that is committed now, None if it is gone
+
+        The transaction of the session is ended first, so the version is not
+        read from the snapshot that the Order was loaded from
+        """
+        db.session.rollback()
+        return db.session.query(cls.version).filter(  # pylint: disable=no-member
+            cls.id == order_id).scalar()
+
+    @classmethod
+    def transition(cls, target, ids=None, **filters):
+        """Moves every matching Order to a new status with one UPDATE
+
+        Only Orders in a status listed in ORDER_TRANSITIONS for the target are
+        changed, which the WHERE clause enforces, and their version is bumped.
+        The items are never loaded. Returns the ids of the changed Orders
+
+        Args:
+            target (OrderStatus): the status to move the Orders to
+            ids (list): the ids of the Orders to move, or None for any id
+            filters: the filters accepted by filter_criteria()
+        """
+        if target not in ORDER_TRANSITIONS:
+            raise DataValidationError(f"Orders cannot be moved to {target.name}")
+        APP.logger.debug("Moving orders to %s", target.name)
+        criteria = cls.filter_criteria(filters)
+        if ids is not None:
+            criteria.append(cls.id.in_(ids))  # pylint: disable=no-member
+        criteria.append(cls.status.in_(ORDER_TRANSITIONS[target]))  # pylint: disable=no-member
+        table = cls.__table__
+        changes = {"status": target, "version": table.c.version + 1}
+        try:
+            if db.session.get_bind().dialect.implicit_returning:  # pylint: disable=no-member
+                result = db.session.execute(
+                    table.update().where(and_(*criteria)).values(changes)
+                    .returning(table.c.id))
+                updated = [row[0] for row in result]  # pylint: disable=not-an-iterable
+            else:
+                rows = db.session.query(cls.id).filter(*criteria)  # pylint: disable=no-member
+                updated = [row[0] for row in rows]
+                if updated:
+                    db.session.execute(
+                        table.update()
+                        .where(and_(table.c.id.in_(updated), criteria[-1]))
+                        .values(changes))
+            Change.record([change_entry("order", order_id, order_id) for order_id in updated])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        invalidate_orders(updated)
+        return sorted(updated)
+
+    @classmethod
+    def find_statuses(cls, ids):
+        """Returns the status of every Order with one of the ids, by id"""
+        if not ids:
+            return {}
+        rows = db.session.query(cls.id, cls.status).filter(  # pylint: disable=no-member
+            cls.id.in_(ids))  # pylint: disable=no-member
+        return dict(rows)
+
+    @classmethod
+    def find_by_status(cls, status, limit=None, after=None):
         """Returns all Orders with the given status
 
         Args:
             status (string): the status of the Order you want to match
+            limit (int): the largest number of Orders to return
+            after (int): only Orders with an id greater than this are returned
         """
         APP.logger.debug("Processing status query for %s ...", status)
-        return cls.query.filter(cls.status == status).all()
+        query = cls.filtered_query(statuses=[status])
+        return cls.paginate(query, limit, after)
 
     @classmethod
-    def find_by_customer(cls, customer_id):
+    def find_by_customer(cls, customer_id, limit=None, after=None):
         """Returns all Orders of the given customer ID
 
         Args:
             customer_id (int): the id of the Customer you want to match
+            limit (int): the largest number of Orders to return
+            after (int): only Orders with an id greater than this are returned
         """
         APP.logger.debug("Processing customer query for %d ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id).all()
+        query = cls.filtered_query(customer_id=customer_id)
+        return cls.paginate(query, limit, after)
+
+
+# The model of the records of every record_type of the change feed
+RECORD_MODELS = {"order": Order, "item": Item}
+
+
+def totals_of_items():
+    """ Returns the total_amount and item_count of an Order as correlated subqueries """
+    items = Item.__table__
+    of_order = items.c.order_id == Order.__table__.c.id
+    return {
+        "total_amount": select([func.coalesce(func.sum(items.c.price * items.c.quantity), 0)])
+                        .where(of_order).as_scalar(),
+        "item_count": select([func.count(items.c.id)]).where(of_order).as_scalar(),
+    }
+
+
+def recompute_totals():
+    """ Sets the totals of every Order to those of its items with one UPDATE """
+    APP.logger.info("Computing the totals of the orders")
+    db.engine.execute(Order.__table__.update().values(**totals_of_items()))
+
+
+def update_totals(order_ids):
+    """
+    Recomputes the totals of Orders from their items and bumps their version
+
+    The totals are summed from the items in the UPDATE itself, not moved by
+    the amount of each write, so the rounding errors of the floats cannot
+    add up. The Orders in the session reload the columns when next read.
+    Every changed Order is appended to the change feed in the same
+    transaction, since its totals and version are part of what it reads
+
+    Args:
+        order_ids (iterable): the ids of the Orders whose items were written
+    """
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    table = Order.__table__
+    db.session.execute(table.update().where(table.c.id.in_(order_ids)).values(
+        version=table.c.version + 1, **totals_of_items()))
+    for order_id in order_ids:
+        order = db.session.identity_map.get(  # pylint: disable=no-member
+            identity_key(Order, order_id))
+        if order is not None:
+            db.session.expire(order, ["total_amount", "item_count", "version"])
+    Change.record([change_entry("order", order_id, order_id) for order_id in order_ids])
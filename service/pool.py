@@ -0,0 +1,126 @@
+"""
+This module contains the database connection pool and the statistics kept about it.
+"""
+import threading
+import time
+from prometheus_client import Counter
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Engine options that only apply to a QueuePool
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+# Prometheus counters of every checkout, which a scrape sums over all workers
+POOL_CHECKOUTS = Counter(
+    "orders_db_pool_checkouts", "Connections handed out by the database pool",
+    ["result"])
+POOL_WAIT = Counter(
+    "orders_db_pool_wait_seconds", "Time spent waiting for pooled connections")
+CHECKOUTS_OK = POOL_CHECKOUTS.labels("ok")
+CHECKOUTS_TIMED_OUT = POOL_CHECKOUTS.labels("timeout")
+
+
+class PoolMonitor():
+    """ Counts the checkouts of pooled connections and how long they waited """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        (self.checkouts, self.timeouts,
+         self.wait_seconds_total, self.wait_seconds_max) = self.zero_counters()
+
+    @staticmethod
+    def zero_counters():
+        """ Returns the checkouts, timeouts, total wait and longest wait before any checkout """
+        return 0, 0, 0.0, 0.0
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        with self.lock:
+            (self.checkouts, self.timeouts,
+             self.wait_seconds_total, self.wait_seconds_max) = self.zero_counters()
+
+    def record_checkout(self, wait_seconds, timed_out=False):
+        """ Records one checkout that waited for the given time """
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def stats(self, pool):
+        """ Returns the counters together with the current state of the pool """
+        with self.lock:
+            stats = {
+                "pool_class": type(pool).__name__,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+            }
+        if isinstance(pool, TimedQueuePool):
+            capacity = pool.size() + max(pool.max_overflow, 0)
+            stats.update({
+                "size": pool.size(),
+                "max_overflow": pool.max_overflow,
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "saturation": pool.checkedout() / capacity if capacity else 0.0,
+            })
+        return stats
+
+
+pool_monitor = PoolMonitor()
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that reports how long every checkout waited for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checking_out = threading.local()
+
+    @property
+    def max_overflow(self):
+        """ The number of connections that may be opened beyond the pool size """
+        return self._max_overflow
+
+    def _do_get(self):
+        # QueuePool retries by calling _do_get again, only time the outer call
+        if getattr(self.checking_out, "active", False):
+            return super()._do_get()
+        self.checking_out.active = True
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            wait_seconds = time.perf_counter() - start
+            pool_monitor.record_checkout(wait_seconds, True)
+            CHECKOUTS_TIMED_OUT.inc()
+            POOL_WAIT.inc(wait_seconds)
+            raise
+        finally:
+            self.checking_out.active = False
+        wait_seconds = time.perf_counter() - start
+        pool_monitor.record_checkout(wait_seconds)
+        CHECKOUTS_OK.inc()
+        POOL_WAIT.inc(wait_seconds)
+        return connection
+
+
+def engine_options(database_uri, options):
+    """
+    Returns the engine options to use for a database
+
+    SQLite does not use a QueuePool, so the pool sizing options are dropped
+    for it, while every other database gets a TimedQueuePool
+    """
+    options = dict(options)
+    if database_uri.startswith("sqlite"):
+        for option in QUEUE_POOL_OPTIONS:
+            options.pop(option, None)
+    else:
+        options.setdefault("poolclass", TimedQueuePool)
+    return options
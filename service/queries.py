@@ -0,0 +1,173 @@
+"""
+This module contains the read-only queries that return plain rows instead of models.
+
+No Order or Item objects are created for their results, so they stay cheap
+however many records they read.
+"""
+from sqlalchemy import distinct, func
+from service import APP
+from service.models import DataValidationError, Item, Order, OrderStatus, db
+
+
+def item_rows(columns, limit=None, after=None, **filters):
+    """Returns one page of Items as plain rows without creating objects
+
+    Args:
+        columns (list): the names of the columns every row holds, in order
+        limit (int): the largest number of Items to return
+        after (int): only Items with an id greater than this are returned
+        filters: the filters accepted by Item.filter_criteria()
+    """
+    query = db.session.query(  # pylint: disable=no-member
+        *[getattr(Item, name) for name in columns]
+    ).filter(*Item.filter_criteria(filters))
+    return Item.paginate(query, limit, after)
+
+
+def item_rows_of_orders(order_ids, columns, chunk_size=500):
+    """Returns the Items of the Orders as plain rows ordered by id
+
+    The ids are sent in chunks so that a long list of Orders does not
+    exceed the number of parameters a database accepts in one statement
+
+    Args:
+        order_ids (list): the ids of the Orders
+        columns (list): the names of the columns every row holds, in order
+    """
+    rows = []
+    for start in range(0, len(order_ids), chunk_size):
+        rows.extend(
+            db.session.query(*[getattr(Item, name) for name in columns])  # pylint: disable=no-member
+            .filter(Item.order_id.in_(order_ids[start:start + chunk_size]))
+            .order_by(Item.id))
+    return rows
+
+
+def order_rows(columns, item_columns=None, limit=None, after=None, sort=None, **filters):
+    """Returns one page of Orders and their Items as plain rows
+
+    Only the named columns are read. The first column must be the id, which
+    the Item rows are looked up by. The sort column is read after them when
+    it is not one of them
+
+    Args:
+        columns (list): the names of the columns every Order row holds
+        item_columns (list): the columns of the Item rows, None for no Items
+        limit (int): the largest number of Orders to return
+        after: the Order the page starts after, as accepted by Order.paginate()
+        sort (tuple): the sort of the page, as accepted by Order.paginate()
+        filters: the filters accepted by Order.filter_criteria()
+    """
+    if sort is not None and sort[0] not in columns:
+        columns = (*columns, sort[0])
+    query = db.session.query(  # pylint: disable=no-member
+        *[getattr(Order, name) for name in columns]
+    ).filter(*Order.filter_criteria(filters))
+    orders = Order.paginate(query, limit, after, sort)
+    if item_columns is None:
+        return orders, []
+    return orders, item_rows_of_orders([row[0] for row in orders], item_columns)
+
+
+def iterate_order_rows(columns, item_columns, batch_size, **filters):
+    """Yields every matching Order and its Items as plain rows, one page at a time
+
+    Each page is a pair of Order rows and Item rows like the one returned
+    by order_rows(), so memory stays flat no matter how many Orders match
+
+    Args:
+        columns (list): the names of the columns every Order row holds
+        item_columns (list): the columns of the Item rows
+        batch_size (int): the number of Orders read per page
+        filters: the filters accepted by Order.filter_criteria()
+    """
+    after = None
+    while True:
+        orders, items = order_rows(columns, item_columns, batch_size, after, **filters)
+        yield orders, items
+        if len(orders) < batch_size:
+            return
+        after = orders[-1][0]
+
+
+def order_stats(group_by, **filters):
+    """Returns the number of Orders and items and their total per group
+
+    The totals are summed by the database with a GROUP BY over the totals
+    kept on the Orders, so the items are not read and only one row per
+    group is returned
+
+    Args:
+        group_by (string): the Order column to group by, status or customer_id
+        filters: the filters accepted by Order.filter_criteria()
+    """
+    if group_by not in ("status", "customer_id"):
+        raise DataValidationError(f"Cannot group orders by '{group_by}'")
+    APP.logger.debug("Processing order stats by %s ...", group_by)
+    column = getattr(Order, group_by)
+    rows = (
+        db.session.query(  # pylint: disable=no-member
+            column,
+            func.count(Order.id),
+            func.coalesce(func.sum(Order.item_count), 0),
+            func.coalesce(func.sum(Order.total_amount), 0),
+        )
+        .filter(*Order.filter_criteria(filters))
+        .group_by(column)
+        .order_by(column)
+    )
+    return [
+        {
+            "group": key.name if isinstance(key, OrderStatus) else key,
+            "order_count": order_count,
+            "item_count": item_count,
+            "total": float(total),
+        }
+        for key, order_count, item_count, total in rows
+    ]
+
+
+def count_by_status():
+    """Returns the number of Orders in every status, including empty ones"""
+    counts = {order_status.name: 0 for order_status in OrderStatus}
+    rows = db.session.query(  # pylint: disable=no-member
+        Order.status, func.count(Order.id)).group_by(Order.status)
+    for order_status, count in rows:
+        counts[order_status.name] = count
+    return counts
+
+
+def top_products(limit):
+    """Returns the products that sold the most units, with one GROUP BY
+
+    Items of cancelled Orders were not sold and are left out. Every
+    product comes with the units sold, the number of Orders and the
+    revenue, sorted by units and then by product id
+
+    Args:
+        limit (int): the number of products to return
+    """
+    APP.logger.debug("Processing top %s products ...", limit)
+    units = func.sum(Item.quantity).label("units")
+    rows = (
+        db.session.query(  # pylint: disable=no-member
+            Item.product_id,
+            units,
+            func.count(distinct(Item.order_id)),
+            func.sum(Item.price * Item.quantity),
+        )
+        .join(Order, Order.id == Item.order_id)
+        .filter(Order.status != OrderStatus.CANCELLED)
+        .group_by(Item.product_id)
+        .order_by(units.desc(), Item.product_id)
+        .limit(limit)
+    )
+    return [
+        {
+            "product_id": product_id,
+            "units": units,
+            "order_count": order_count,
+            "revenue": float(revenue),
+        }
+        for product_id, units, order_count, revenue in rows
+    ]
@@ -2,7 +2,8 @@
 This package contains all the API route definitions for the Orders microservice
 """
 
-from . import common, orders, items
+from . import common, orders, items, diagnostics
 
 common.APP.logger.info("Initialized routes for %s", orders.__name__)
 common.APP.logger.info("Initialized routes for %s", items.__name__)
+common.APP.logger.info("Initialized routes for %s", diagnostics.__name__)
@@ -2,9 +2,22 @@
 This module contains the common routes and utility functions for the Orders microservice.
 
 """
+import base64
+import binascii
+import functools
+import hashlib
+import json
+import time
+from enum import Enum
+from urllib.parse import urlencode
+from flask import Response, request
 from flask_restx import Api
-from service import APP, status
-from service.models import DataValidationError, DatabaseConnectionError, Order, Item
+from flask_restx.utils import unpack
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.http import quote_etag
+from service import APP, instrumentation, metrics, serializers, status
+from service.idempotency import IdempotencyKey
+from service.models import DataValidationError, DatabaseConnectionError, Order, Item, db
 
 @APP.route('/')
 def index():
@@ -54,6 +67,33 @@ def database_connection_error(error):
         'message': message
     }, status.HTTP_503_SERVICE_UNAVAILABLE
 
+
+@API.errorhandler(StaleDataError)
+def stale_data_error(error):
+    """ Handles writes to records that were changed by another request """
+    message = str(error)
+    APP.logger.warning(message)
+    db.session.rollback()
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': 'The resource was modified by another request'
+    }, status.HTTP_409_CONFLICT
+
+
+class NotModified(Exception):
+    """ Used to answer a conditional GET whose entity tag still matches """
+
+    def __init__(self, etag):
+        super().__init__(f"Not modified: {etag}")
+        self.etag = etag
+
+
+@API.errorhandler(NotModified)
+def not_modified(error):
+    """ Handles conditional GETs of unchanged resources, which have no body """
+    return {}, status.HTTP_304_NOT_MODIFIED, etag_header(error.etag)
+
 ######################################################################
 ###########      U T I L I T Y    F U N C T I O N S      #############
 ######################################################################
@@ -63,9 +103,199 @@ def init_db():
     """ Initializes the SQLAlchemy app """
     Item.init_db(APP)
     Order.init_db(APP)
+    instrumentation.install(APP, API)
+    metrics.install(APP)
 
 
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     APP.logger.error(message)
     API.abort(error_code, message)
+
+
+def json_response(documents, headers=None):
+    """Returns documents built by the serializers module as a 200 response"""
+    return Response(serializers.dumps(documents), status.HTTP_200_OK,
+                    headers, mimetype='application/json')
+
+
+def etag_header(etag):
+    """Returns the response headers that carry an entity tag"""
+    return {'ETag': quote_etag(etag)}
+
+
+def check_etag(etag):
+    """
+    Evaluates the conditional request headers against the current entity tag
+
+    A GET whose If-None-Match contains the tag raises NotModified, and a write
+    whose If-Match does not contain it is aborted with 412 Precondition Failed
+    """
+    if request.method in ('GET', 'HEAD'):
+        if request.if_none_match.contains_weak(etag):
+            raise NotModified(etag)
+    elif request.if_match and not request.if_match.contains(etag):
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              "The resource has changed since it was last fetched.")
+
+
+######################################################################
+###########         P A G I N A T I O N                  #############
+######################################################################
+
+
+def page_limit(value):
+    """Parses the limit query argument of a paginated collection"""
+    limit = int(value)
+    if limit < 1 or limit > APP.config["MAX_PAGE_SIZE"]:
+        raise ValueError(
+            f"limit must be between 1 and {APP.config['MAX_PAGE_SIZE']}")
+    return limit
+
+
+page_limit.__schema__ = {"type": "integer", "minimum": 1}
+
+
+def add_pagination_args(parser):
+    """Adds the keyset pagination arguments to a request parser"""
+    parser.add_argument('limit', type=page_limit, required=False,
+                        location='args',
+                        help='The largest number of results to return')
+    parser.add_argument('after', type=str, required=False, location='args',
+                        help='The cursor returned with the previous page')
+    return parser
+
+
+def add_fields_arg(parser):
+    """Adds the argument that selects the fields of a partial response"""
+    parser.add_argument('fields', type=str, required=False, location='args',
+                        help='The comma separated fields to return, '
+                             'e.g. id,status,items.product_id')
+    return parser
+
+
+def encode_cursor(last_id, key=None):
+    """
+    Encodes the id of the last record of a page as an opaque cursor, along
+    with its sort key when the page is sorted by another column
+    """
+    data = {"id": last_id}
+    if key is not None:
+        data["key"] = key.name if isinstance(key, Enum) else key
+    return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, sort=None):
+    """
+    Decodes a cursor returned by encode_cursor back into a record id, or into
+    the (sort key, id) of the record when sorted by another column
+    """
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if sort is not None and sort[0] != "id":
+            return data["key"], int(data["id"])
+        return int(data["id"])
+    except (binascii.Error, ValueError, TypeError, KeyError) as error:
+        raise DataValidationError(f"Invalid cursor '{cursor}'") from error
+
+
+def next_page_headers(records, limit, sort=None):
+    """
+    Returns the headers that point a client at the next page of records
+
+    A full page means there may be more records, so a cursor to the last record
+    is returned in X-Next-Cursor and as a Link header with rel="next"
+    """
+    if limit is None or len(records) < limit:
+        return {}
+    key = None
+    if sort is not None and sort[0] != "id":
+        key = getattr(records[-1], sort[0])
+    cursor = encode_cursor(records[-1].id, key)
+    args = request.args.to_dict()
+    args["after"] = cursor
+    url = f"{request.base_url}?{urlencode(args)}"
+    return {"Link": f'<{url}>; rel="next"', "X-Next-Cursor": cursor}
+
+
+######################################################################
+###########        I D E M P O T E N C Y                 #############
+######################################################################
+
+
+class KeyPurge():  # pylint: disable=too-few-public-methods
+    """ Removes the expired Idempotency-Keys now and then """
+
+    def __init__(self):
+        self.purged = 0.0
+
+    def run(self, now):
+        """ Purges the expired keys if the last purge of this worker is old enough """
+        if now - self.purged >= APP.config["IDEMPOTENCY_PURGE_SECONDS"]:
+            self.purged = now
+            count = IdempotencyKey.purge_expired()
+            APP.logger.debug("Purged %d expired idempotency keys", count)
+
+
+key_purge = KeyPurge()
+
+
+def idempotent(func):
+    """
+    Makes a POST replay its response to retries with the same Idempotency-Key
+
+    The first request with a key runs and its successful response is stored
+    for IDEMPOTENCY_TTL seconds, in the same transaction as its writes. Retries
+    get that response without running the request again, while a request with
+    the key that is still running answers 409 and a key that was sent with
+    another body answers 422
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return func(*args, **kwargs)
+        if not key or len(key) > 255:
+            raise DataValidationError("Idempotency-Key must have 1 to 255 characters")
+        key_purge.run(time.monotonic())
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+        record, claimed = IdempotencyKey.claim(
+            {"key": key, "method": request.method, "path": request.path},
+            request_hash, APP.config["IDEMPOTENCY_CLAIM_SECONDS"])
+        if not claimed:
+            return replay(record, request_hash)
+        record.hold_writes(APP.config["IDEMPOTENCY_CLAIM_SECONDS"])
+        try:
+            data, code, headers = unpack(func(*args, **kwargs))
+        except Exception:
+            record.release()
+            raise
+        if 200 <= code < 300:
+            record.save_response(code, json.dumps(data), headers.get("Location"),
+                                 APP.config["IDEMPOTENCY_TTL"])
+        else:
+            record.release()
+        return data, code, headers
+
+    return API.doc(params={"Idempotency-Key": {
+        "in": "header", "type": "string",
+        "description": "A unique key that makes retries of the request return its "
+                       "first response instead of running it again",
+    }})(wrapper)
+
+
+def replay(record, request_hash):
+    """ Returns the stored response of the request that claimed a key """
+    if record is not None and record.request_hash != request_hash:
+        abort(status.HTTP_422_UNPROCESSABLE_ENTITY,
+              "The Idempotency-Key was already used for a different request.")
+    if record is None or record.status_code is None:
+        abort(status.HTTP_409_CONFLICT,
+              "A request with the Idempotency-Key is still being processed.")
+    APP.logger.info("Replaying the response to Idempotency-Key %s", record.key)
+    headers = {"Idempotent-Replayed": "true"}
+    if record.location:
+        headers["Location"] = record.location
+    return json.loads(record.body), record.status_code, headers
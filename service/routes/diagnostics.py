@@ -0,0 +1,85 @@
+"""
+This module contains the routes that report on the internals of the Orders microservice.
+"""
+from flask import make_response
+from flask_restx import Resource, fields
+from service import APP, metrics, status
+from service.cache import order_cache
+from service.models import db
+from service.pool import pool_monitor
+from service.routes.common import API
+
+# pylint: disable=no-self-use
+
+cache_stats_model = API.model('CacheStats', {
+    'backend': fields.String(description='The cache backend in use'),
+    'hits': fields.Integer(description='Order lookups answered from the cache'),
+    'misses': fields.Integer(description='Order lookups that read the database'),
+})
+
+pool_stats_model = API.model('PoolStats', {
+    'pool_class': fields.String(description='The connection pool in use'),
+    'checkouts': fields.Integer(description='Connections handed out by the pool'),
+    'timeouts': fields.Integer(description='Checkouts that gave up waiting'),
+    'wait_seconds_total': fields.Float(description='Time spent waiting for connections'),
+    'wait_seconds_max': fields.Float(description='Longest wait for a connection'),
+    'size': fields.Integer(description='Connections kept open by the pool'),
+    'max_overflow': fields.Integer(description='Connections allowed beyond the size'),
+    'checked_in': fields.Integer(description='Idle connections'),
+    'checked_out': fields.Integer(description='Connections in use'),
+    'overflow': fields.Integer(description='Connections open beyond the size'),
+    'saturation': fields.Float(description='Share of all allowed connections in use'),
+})
+
+######################################################################
+#  PATH: /diagnostics/cache
+######################################################################
+
+
+@API.route('/diagnostics/cache')
+class CacheStats(Resource):
+    """ Reports on the cache of serialized Orders """
+
+    @API.doc('get_cache_stats')
+    @API.marshal_with(cache_stats_model)
+    def get(self):
+        """
+        Returns the cache counters
+
+        The counters are kept per worker process
+        """
+        APP.logger.info("Request for cache stats")
+        return order_cache.stats(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /diagnostics/pool
+######################################################################
+
+
+@API.route('/diagnostics/pool')
+class PoolStats(Resource):
+    """ Reports on the database connection pool """
+
+    @API.doc('get_pool_stats')
+    @API.marshal_with(pool_stats_model, skip_none=True)
+    def get(self):
+        """
+        Returns the connection pool counters
+
+        The counters are kept per worker process
+        """
+        APP.logger.info("Request for pool stats")
+        return pool_monitor.stats(db.engine.pool), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /metrics
+######################################################################
+
+
+@APP.route('/metrics')
+def prometheus_metrics():
+    """ Exposes the metrics of every worker in the Prometheus text format """
+    body, content_type = metrics.render()
+    return make_response(body, status.HTTP_200_OK, {'Content-Type': content_type})
@@ -1,10 +1,12 @@
 """
 This module contains all the API routes for orders.
 """
-from flask_restx import Resource, fields
-from service.models import Order, Item
-from service import APP, status
-from service.routes.common import API, abort
+from flask_restx import Resource, fields, marshal, reqparse
+from service.models import DataValidationError, Order, Item, etag_of
+from service import APP, queries, serializers, status
+from service.routes.common import (API, abort, add_fields_arg, add_pagination_args,
+                                   check_etag, decode_cursor, etag_header, idempotent,
+                                   json_response, next_page_headers, page_limit)
 
 # pylint: disable=no-self-use
 
@@ -28,12 +30,71 @@ item_model = API.inherit(
     },
 )
 
+top_product_model = API.model('TopProduct', {
+    'product_id': fields.Integer(description='The product'),
+    'units': fields.Integer(description='The quantity sold in orders that were not cancelled'),
+    'order_count': fields.Integer(description='The number of orders the product was sold in'),
+    'revenue': fields.Float(description='The sum of price * quantity of the product'),
+})
+
+# query string arguments
+item_args = add_fields_arg(add_pagination_args(reqparse.RequestParser()))
+item_args.add_argument('product-id', type=int, required=False, location='args',
+                       help='List items of a product')
+item_args.add_argument('min-price', type=float, required=False, location='args',
+                       help='List items with a price of at least this value')
+item_args.add_argument('max-price', type=float, required=False, location='args',
+                       help='List items with a price of at most this value')
+item_args.add_argument('min-quantity', type=int, required=False, location='args',
+                       help='List items with a quantity of at least this value')
+item_args.add_argument('max-quantity', type=int, required=False, location='args',
+                       help='List items with a quantity of at most this value')
+
+top_product_args = reqparse.RequestParser()
+top_product_args.add_argument('limit', type=page_limit, required=False, default=10,
+                              location='args', help='The number of products to return')
+
+item_fields_args = add_fields_arg(reqparse.RequestParser())
+
+
+def item_filters(args):
+    """Returns the Item.filter_criteria() filters from the query string"""
+    return {
+        'product_id': args['product-id'],
+        'min_price': args['min-price'],
+        'max_price': args['max-price'],
+        'min_quantity': args['min-quantity'],
+        'max_quantity': args['max-quantity'],
+    }
+
+
+def find_item_or_404(order_id, item_id, columns=None):
+    """
+    Returns an Item of an Order with a single query
+
+    Only when the Item is missing is the Order looked up, to tell which of
+    the two was not found
+    """
+    item = Item.find_in_order(order_id, item_id, columns)
+    if not item:
+        check_order_exists(order_id)
+        abort(status.HTTP_404_NOT_FOUND,
+              f"Item with id '{item_id}' was not found.")
+    return item
+
+
+def check_order_exists(order_id):
+    """Aborts with 404 unless the Order exists, without loading it"""
+    if not Order.exists(order_id):
+        abort(status.HTTP_404_NOT_FOUND,
+              f"Order with id '{order_id}' was not found.")
+
 
 ######################################################################
 #  PATH: /orders/{order_id}/items/{item_id}
 ######################################################################
 
-@API.route('/orders/<order_id>/items/<item_id>')
+@API.route('/orders/<int:order_id>/items/<int:item_id>')
 @API.param('order_id', 'The Order identifier')
 @API.param('item_id', 'The Item identifier')
 class ItemResource(Resource):
@@ -50,8 +111,10 @@ class ItemResource(Resource):
     # FETCH ITEM
     # ------------------------------------------------------------------
     @API.doc('get_items')
+    @API.expect(item_fields_args, validate=True)
+    @API.response(200, 'Success', item_model)
     @API.response(404, 'Item not found')
-    @API.marshal_with(item_model)
+    @API.response(304, 'Item not modified since the ETag in If-None-Match')
     def get(self, order_id, item_id):
         """
         Retrieve a single Item
@@ -59,15 +122,17 @@ class ItemResource(Resource):
         This endpoint will return an Item based on its id
         """
         APP.logger.info("Request for item with id [%s]", item_id)
-        order = Order.find(order_id)
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Order with id '{order_id}' was not found.")
-        item = Item.find(item_id)
-        if not item:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Item with id '{item_id}' was not found.")
-        return item.serialize()
+        projection = serializers.item_projection(item_fields_args.parse_args()['fields'])
+        if projection is not serializers.FULL_PROJECTION:
+            item = find_item_or_404(order_id, item_id, projection.item_fields)
+            etag = etag_of([item], projection.key())
+            check_etag(etag)
+            return (serializers.item_document(item, projection), status.HTTP_200_OK,
+                    etag_header(etag))
+        item = find_item_or_404(order_id, item_id)
+        check_etag(item.etag())
+        return (marshal(item.serialize(), item_model), status.HTTP_200_OK,
+                etag_header(item.etag()))
 
     # ------------------------------------------------------------------
     # UPDATE ITEM
@@ -75,6 +140,7 @@ class ItemResource(Resource):
     @API.doc('update_items')
     @API.response(404, 'Item not found')
     @API.response(400, 'The posted Item data was not valid')
+    @API.response(412, 'Item changed since the ETag in If-Match')
     @API.expect(item_model)
     @API.marshal_with(item_model)
     def put(self, order_id, item_id):
@@ -85,21 +151,15 @@ class ItemResource(Resource):
         """
         APP.logger.info(
             "Request to update item with order_id [%s] and item_id [%s]", order_id, item_id)
-        order = Order.find(order_id)
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Order with id '{order_id}' was not found.")
-        item = Item.find(item_id)
-        if not item:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Item with id '{item_id}' was not found.")
+        item = find_item_or_404(order_id, item_id)
+        check_etag(item.etag())
         data = API.payload
         APP.logger.debug("Payload = %s", data)
         item.deserialize(data)
         item.id = item_id
         item.order_id = order_id
         item.update()
-        return item.serialize(), status.HTTP_200_OK
+        return item.serialize(), status.HTTP_200_OK, etag_header(item.etag())
 
     # ------------------------------------------------------------------
     # DELETE ITEM
@@ -114,14 +174,11 @@ class ItemResource(Resource):
         """
         APP.logger.info(
             "Request to delete item with order_id [%s] and item_id [%s]", order_id, item_id)
-
-        order = Order.find(order_id)
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Order with id '{order_id}' was not found.")
-        item = Item.find(item_id)
+        item = Item.find_in_order(order_id, item_id)
         if item:
             item.delete()
+        else:
+            check_order_exists(order_id)
         return "", status.HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -129,43 +186,55 @@ class ItemResource(Resource):
 ######################################################################
 
 
-@API.route('/orders/<order_id>/items', strict_slashes=False)
+@API.route('/orders/<int:order_id>/items', strict_slashes=False)
 class ItemOrderCollection(Resource):
     """ Handles interactions with collections of Items for an Order """
     # ------------------------------------------------------------------
     # LIST ITEMS FOR ORDER
     # ------------------------------------------------------------------
     @API.doc('list_items_for_order')
-    @API.marshal_list_with(item_model)
+    @API.expect(item_fields_args, validate=True)
+    @API.response(200, 'Success', [item_model])
+    @API.response(304, 'Items not modified since the ETag in If-None-Match')
     def get(self, order_id):
         """ Returns all of the Items for an Order """
 
         APP.logger.info("Request to list items for order id [%s]", order_id)
-        order = Order.find(order_id)
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Order with id '{order_id}' was not found.")
-        results = [item.serialize() for item in order.items]
-        return results, status.HTTP_200_OK
+        projection = serializers.item_projection(item_fields_args.parse_args()['fields'])
+        if projection is not serializers.FULL_PROJECTION:
+            items = Item.find_by_order(order_id, projection.item_fields)
+            variant = projection.key()
+        else:
+            items = serializers.item_records(
+                queries.item_rows_of_orders([order_id], serializers.ItemRecord.COLUMNS))
+            variant = None
+        if not items:
+            check_order_exists(order_id)
+        etag = etag_of(items, variant)
+        check_etag(etag)
+        if variant is not None:
+            results = [serializers.item_document(item, projection) for item in items]
+        else:
+            results = marshal([item.serialize() for item in items], item_model)
+        return results, status.HTTP_200_OK, etag_header(etag)
 
     # ------------------------------------------------------------------
     # CREATE ITEM
     # ------------------------------------------------------------------
     @API.doc('create_items')
     @API.response(400, 'The posted data was not valid')
+    @API.response(409, 'A request with the Idempotency-Key is still running')
+    @API.response(422, 'The Idempotency-Key was used for a different item')
     @API.expect(item_create_model)
+    @idempotent
     @API.marshal_with(item_model, code=201)
     def post(self, order_id):
         """
         Creates an Item associated with an Order
 
         """
-        APP.logger.info("Request to create an item")
-        order = Order.find(order_id)
-        APP.logger.info(str(order))
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND,
-                  f"Order with id '{order_id}' was not found.")
+        APP.logger.info("Request to create an item for order id [%s]", order_id)
+        check_order_exists(order_id)
 
         data = API.payload
         APP.logger.debug("Payload = %s", data)
@@ -180,6 +249,53 @@ class ItemOrderCollection(Resource):
         # order.update()
         return item.serialize(), status.HTTP_201_CREATED
 
+######################################################################
+#  PATH: /orders/{order_id}/items/bulk
+######################################################################
+
+
+@API.route('/orders/<int:order_id>/items/bulk')
+@API.param('order_id', 'The Order identifier')
+class ItemOrderBulk(Resource):
+    """ Adds many Items to an Order in one request """
+
+    # ------------------------------------------------------------------
+    # CREATE ITEMS
+    # ------------------------------------------------------------------
+    @API.doc('create_items_bulk')
+    @API.response(400, 'The posted data was not a list of valid items')
+    @API.response(404, 'Order not found')
+    @API.expect([item_create_model])
+    @API.marshal_list_with(item_model, code=201)
+    def post(self, order_id):
+        """
+        Creates many Items associated with an Order
+
+        This endpoint validates every Item in the posted list and, only if all
+        of them are valid, adds them to the Order in a single transaction
+        """
+        data = API.payload
+        if not isinstance(data, list):
+            raise DataValidationError(
+                "Invalid request: body must be a list of items")
+        if len(data) > APP.config['MAX_BULK_SIZE']:
+            raise DataValidationError(
+                f"Invalid request: at most {APP.config['MAX_BULK_SIZE']} "
+                "items can be created at once")
+        APP.logger.info("Request to add %d items to order [%s]", len(data), order_id)
+        check_order_exists(order_id)
+
+        items = []
+        for index, item_data in enumerate(data):
+            try:
+                items.append(Item().deserialize(item_data))
+            except DataValidationError as error:
+                raise DataValidationError(f"Item {index}: {error}") from error
+
+        created = Item.create_many(order_id, items)
+        APP.logger.info("Added %d items to order [%s]", len(created), order_id)
+        return [item.serialize() for item in created], status.HTTP_201_CREATED
+
 ######################################################################
 #  PATH: /items
 ######################################################################
@@ -193,13 +309,48 @@ class ItemCollection(Resource):
     # LIST ALL ITEMS
     # ------------------------------------------------------------------
     @API.doc('list_items')
-    @API.marshal_list_with(item_model)
+    @API.expect(item_args, validate=True)
+    @API.response(200, 'Success', [item_model])
     def get(self):
         """
         Lists all Items
 
         """
-        all_items = Item.all()
-        results = [Item.serialize(item) for item in all_items]
+        args = item_args.parse_args()
+        limit = args['limit']
+        after = decode_cursor(args['after'])
+        projection = serializers.item_projection(args['fields'])
+        if APP.config['FAST_JSON'] or projection is not serializers.FULL_PROJECTION:
+            rows = queries.item_rows(projection.item_columns, limit, after, **item_filters(args))
+            return json_response(serializers.item_documents(rows, projection),
+                                 next_page_headers(rows, limit))
+        all_items = Item.paginate(Item.filtered_query(**item_filters(args)), limit, after)
+        results = marshal([Item.serialize(item) for item in all_items], item_model)
+
+        return results, status.HTTP_200_OK, next_page_headers(all_items, limit)
+
+######################################################################
+#  PATH: /items/top-products
+######################################################################
+
+
+@API.route('/items/top-products')
+class TopProducts(Resource):
+    """ The products that sold the most units """
+
+    # ------------------------------------------------------------------
+    # TOP PRODUCTS
+    # ------------------------------------------------------------------
+    @API.doc('top_products')
+    @API.expect(top_product_args, validate=True)
+    @API.marshal_list_with(top_product_model)
+    def get(self):
+        """
+        Returns the products that sold the most units
 
-        return results, status.HTTP_200_OK
+        This endpoint sums the quantities of the items of every product with
+        one GROUP BY in the database, leaving out cancelled orders
+        """
+        args = top_product_args.parse_args()
+        APP.logger.info("Request for the top %s products", args['limit'])
+        return queries.top_products(args['limit']), status.HTTP_200_OK
@@ -1,10 +1,17 @@
 """
 This module contains all the API routes for orders.
 """
-from flask_restx import Resource, fields, reqparse
-from service.models import Order, OrderStatus
-from service import APP, status
-from service.routes.common import API, abort
+import json
+from flask import Response, stream_with_context
+from flask_restx import Resource, fields, marshal, reqparse
+from service.changes import Change
+from service.models import RECORD_MODELS, DataValidationError, Order, OrderStatus, etag_of
+from service import APP, queries, serializers, status
+from service.cache import order_cache
+from service.routes.common import (API, abort, add_fields_arg, add_pagination_args,
+                                   check_etag, decode_cursor, encode_cursor,
+                                   etag_header, idempotent, json_response,
+                                   next_page_headers, page_limit)
 from service.routes.items import item_create_model, item_model
 
 # pylint: disable=no-self-use
@@ -37,22 +44,157 @@ order_model = API.inherit(
                              description='The items that the order contains'),
         'id': fields.Integer(readOnly=True,
                              description='The unique id assigned internally by service'),
+        'total_amount': fields.Float(readOnly=True,
+                                     description='The sum of price * quantity of the items'),
+        'item_count': fields.Integer(readOnly=True,
+                                     description='The number of items in the order'),
     }
 )
 
+order_bulk_result_model = API.model('OrderBulkResult', {
+    'index': fields.Integer(description='The position of the order in the request'),
+    'status_code': fields.Integer(description='The outcome of creating the order'),
+    'message': fields.String(description='Why the order was not created'),
+    'order': fields.Nested(order_model, allow_null=True,
+                           description='The order that was created'),
+})
+
+
+order_transition_model = API.model('OrderTransition', {
+    'to': fields.String(required=True, enum=[s.name for s in OrderStatus],
+                        description='The status to move the orders to'),
+    'ids': fields.List(fields.Integer, required=False,
+                       description='The orders to move, or all that match the filters'),
+})
+
+order_transition_result_model = API.model('OrderTransitionResult', {
+    'id': fields.Integer(description='The id of the order'),
+    'status_code': fields.Integer(description='The outcome of moving the order'),
+    'status': fields.String(description='The status the order is in now'),
+    'message': fields.String(description='Why the order was not moved'),
+})
+
+
+def order_status(value):
+    """Parses the name of an OrderStatus from a query string argument"""
+    try:
+        return OrderStatus[value]
+    except KeyError as error:
+        raise ValueError(f"'{value}' is not a valid order status") from error
+
+
+order_status.__schema__ = {"type": "string",
+                           "enum": [s.name for s in OrderStatus]}
+
+ORDER_SORT_KEYS = sorted(Order.sortable_columns())
+
+
+def order_sort(value):
+    """Parses a sort key of the Orders, e.g. -total_amount for descending"""
+    name = value[1:] if value.startswith("-") else value
+    if name not in ORDER_SORT_KEYS:
+        raise ValueError(f"Orders can only be sorted by {', '.join(ORDER_SORT_KEYS)}")
+    return name, value.startswith("-")
+
+
+order_sort.__schema__ = {"type": "string",
+                         "enum": [f"{sign}{key}" for key in ORDER_SORT_KEYS
+                                  for sign in ("", "-")]}
+
+order_change_model = API.model('OrderChange', {
+    'seq': fields.Integer(description='The position of the change in the feed'),
+    'type': fields.String(enum=['order', 'item'], description='The kind of record'),
+    'id': fields.Integer(description='The id of the order or item'),
+    'order_id': fields.Integer(description='The order the record belongs to'),
+    'deleted': fields.Boolean(description='True if the record no longer exists'),
+    'order': fields.Nested(order_model, allow_null=True,
+                           description='The order as it is now'),
+    'item': fields.Nested(item_model, allow_null=True,
+                          description='The item as it is now'),
+})
+
+order_change_feed_model = API.model('OrderChangeFeed', {
+    'changes': fields.List(fields.Nested(order_change_model, skip_none=True)),
+    'cursor': fields.String(description='The cursor to pass as since for the next changes'),
+    'more': fields.Boolean(description='True if more changes may be read right away'),
+})
+
+order_stats_model = API.model('OrderStats', {
+    'group': fields.Raw(description='The status or customer id of the group'),
+    'order_count': fields.Integer(description='The number of orders in the group'),
+    'item_count': fields.Integer(description='The number of items in the group'),
+    'total': fields.Float(description='The sum of price * quantity of the items'),
+})
+
 # query string arguments
-order_args = reqparse.RequestParser()
-order_args.add_argument('status', type=str, required=False,
-                        help='List orders by status')
-order_args.add_argument('customer-id', type=str,
-                        required=False, help='List orders of a customer')
+filter_args = reqparse.RequestParser()
+filter_args.add_argument('status', type=order_status, required=False,
+                         action='split', location='args',
+                         help='List orders in any of these comma separated statuses')
+filter_args.add_argument('customer-id', type=int, required=False,
+                         location='args', help='List orders of a customer')
+filter_args.add_argument('tracking-id', type=int, required=False,
+                         location='args', help='List orders with a tracking id')
+filter_args.add_argument('min-id', type=int, required=False, location='args',
+                         help='List orders with an id of at least this value')
+filter_args.add_argument('max-id', type=int, required=False, location='args',
+                         help='List orders with an id of at most this value')
+filter_args.add_argument('min-total', type=float, required=False, location='args',
+                         help='List orders with a total amount of at least this value')
+filter_args.add_argument('max-total', type=float, required=False, location='args',
+                         help='List orders with a total amount of at most this value')
+filter_args.add_argument('min-items', type=int, required=False, location='args',
+                         help='List orders with at least this many items')
+filter_args.add_argument('max-items', type=int, required=False, location='args',
+                         help='List orders with at most this many items')
+filter_args.add_argument('product-id', type=int, required=False, location='args',
+                         help='List orders that contain a product')
+
+order_args = add_fields_arg(add_pagination_args(filter_args.copy()))
+order_args.add_argument('sort', type=order_sort, required=False, location='args',
+                        help='The column to sort the orders by, with a leading - '
+                             'for descending order')
+
+order_fields_args = add_fields_arg(reqparse.RequestParser())
+
+export_args = filter_args.copy()
+export_args.add_argument('format', type=str, required=False, default='ndjson',
+                         choices=('ndjson',), location='args',
+                         help='The format of the export')
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=str, required=False, location='args',
+                         help='The cursor returned with the previous changes')
+change_args.add_argument('limit', type=page_limit, required=False, location='args',
+                         help='The largest number of changes to read')
+
+stats_args = filter_args.copy()
+stats_args.add_argument('group_by', type=str, required=False, default='status',
+                        choices=('status', 'customer_id'), location='args',
+                        help='The order column to group the totals by')
+
+
+def order_filters(args):
+    """Returns the Order.filter_criteria() filters from the query string"""
+    return {
+        'statuses': args['status'],
+        'customer_id': args['customer-id'],
+        'tracking_id': args['tracking-id'],
+        'min_id': args['min-id'],
+        'max_id': args['max-id'],
+        'min_total': args['min-total'],
+        'max_total': args['max-total'],
+        'min_items': args['min-items'],
+        'max_items': args['max-items'],
+        'product_id': args['product-id'],
+    }
 
 ######################################################################
 #  PATH: /orders/{id}
 ######################################################################
 
 
-@API.route('/orders/<order_id>')
+@API.route('/orders/<int:order_id>')
 @API.param('order_id', 'The Order identifier')
 class OrderResource(Resource):
     """
@@ -68,19 +210,60 @@ class OrderResource(Resource):
     # FETCH ORDER
     # ------------------------------------------------------------------
     @API.doc('get_orders')
+    @API.expect(order_fields_args, validate=True)
+    @API.response(200, 'Success', order_model)
     @API.response(404, 'Order not found')
-    @API.marshal_with(order_model)
+    @API.response(304, 'Order not modified since the ETag in If-None-Match')
     def get(self, order_id):
         """
         Retrieve a single Order
         This endpoint will return a order based on it's id
         """
         APP.logger.info("Request for order with id: %s", order_id)
+        projection = serializers.order_projection(order_fields_args.parse_args()['fields'])
+        if projection is not serializers.FULL_PROJECTION:
+            return self.get_projected(order_id, projection)
+        cached = order_cache.get(order_id) or self.read_order(order_id)
+        check_etag(cached['etag'])
+        return (marshal(cached['order'], order_model), status.HTTP_200_OK,
+                etag_header(cached['etag']))
+
+    @staticmethod
+    def read_order(order_id):
+        """
+        Reads an Order that missed the cache and caches its serialized form
+
+        The ETag is checked before the Order is serialized, so a client whose
+        copy is current costs no serialization. A write that commits while
+        the Order is read invalidates the cache before the copy is stored, so
+        the copy is dropped again when the version has moved on meanwhile
+        """
         order = Order.find(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Order with id '{order_id}' was not found.")
-        return order.serialize(), status.HTTP_200_OK
+        etag = order.etag()
+        check_etag(etag)
+        version = order.version
+        cached = {'etag': etag, 'order': order.serialize()}
+        order_cache.set(order_id, cached)
+        if Order.committed_version(order_id) != version:
+            order_cache.invalidate(order_id)
+        return cached
+
+    @staticmethod
+    def get_projected(order_id, projection):
+        """ Returns the fields of an Order that a partial response asked for """
+        order = Order.find_projected(order_id, projection.order_columns,
+                                     projection.order_item_columns)
+        if not order:
+            abort(status.HTTP_404_NOT_FOUND,
+                  f"Order with id '{order_id}' was not found.")
+        records = [order, *order.items] if projection.includes_items else [order]
+        etag = etag_of(records, projection.key())
+        check_etag(etag)
+        return (serializers.order_document(order, projection), status.HTTP_200_OK,
+                etag_header(etag))
 
     # ------------------------------------------------------------------
     # UPDATE ORDER
@@ -88,6 +271,7 @@ class OrderResource(Resource):
     @API.doc('update_orders')
     @API.response(404, 'Order not found')
     @API.response(400, 'The posted Order data was not valid')
+    @API.response(412, 'Order changed since the ETag in If-Match')
     @API.expect(order_model)
     @API.marshal_with(order_model)
     def put(self, order_id):
@@ -101,6 +285,7 @@ class OrderResource(Resource):
         if not order:
             abort(status.HTTP_404_NOT_FOUND,
                   f"Order with id [{order_id}] was not found.")
+        check_etag(order.etag())
         data = API.payload
         APP.logger.debug("Payload = %s", data)
         # Remove items because we do not want to update them through this endpoint
@@ -110,7 +295,7 @@ class OrderResource(Resource):
 
         order.id = order_id
         order.update()
-        return order.serialize(), status.HTTP_200_OK
+        return order.serialize(), status.HTTP_200_OK, etag_header(order.etag())
 
     # ------------------------------------------------------------------
     # DELETE ORDER
@@ -143,37 +328,36 @@ class OrderCollection(Resource):
     # ------------------------------------------------------------------
     @API.doc('list_orders')
     @API.expect(order_args, validate=True)
-    @API.marshal_list_with(order_model)
+    @API.response(200, 'Success', [order_model])
     def get(self):
         """ Returns all of the Orders """
         APP.logger.info("Request to list orders...")
-        APP.logger.info("Parsing args")
-        if order_args:
-            args = order_args.parse_args()
-        APP.logger.info("Parsed args")
-        if args is not None:
-            if 'status' in args:
-                order_status = args['status']
-            if 'customer-id' in args:
-                customer_id_str = args['customer-id']
-        if order_status:
-            APP.logger.info('Filtering by status: %s', order_status)
-            orders = Order.find_by_status(OrderStatus[order_status])
-        elif customer_id_str:
-            APP.logger.info('Filtering by customer id: [%s]', customer_id_str)
-            orders = Order.find_by_customer(int(customer_id_str))
-        else:
-            APP.logger.info('Returning unfiltered list')
-            orders = Order.all()
-        results = [order.serialize() for order in orders]
-        return results, status.HTTP_200_OK
+        args = order_args.parse_args()
+        APP.logger.info('Filtering by %s', args)
+        limit = args['limit']
+        sort = args['sort']
+        after = decode_cursor(args['after'], sort)
+        projection = serializers.order_projection(args['fields'])
+        if APP.config['FAST_JSON'] or projection is not serializers.FULL_PROJECTION:
+            orders, items = queries.order_rows(projection.order_columns,
+                                               projection.order_item_columns,
+                                               limit, after, sort, **order_filters(args))
+            return json_response(serializers.order_documents(orders, items, projection),
+                                 next_page_headers(orders, limit, sort))
+        query = Order.filtered_query(**order_filters(args))
+        orders = Order.paginate(query, limit, after, sort)
+        results = marshal([order.serialize() for order in orders], order_model)
+        return results, status.HTTP_200_OK, next_page_headers(orders, limit, sort)
 
     # ------------------------------------------------------------------
     # CREATE ORDER
     # ------------------------------------------------------------------
     @API.doc('create_orders')
     @API.response(400, 'The posted data was not valid')
+    @API.response(409, 'A request with the Idempotency-Key is still running')
+    @API.response(422, 'The Idempotency-Key was used for a different order')
     @API.expect(order_create_model)
+    @idempotent
     @API.marshal_with(order_model, code=201)
     def post(self):
         """
@@ -200,11 +384,263 @@ class OrderCollection(Resource):
         return order.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 ######################################################################
-#  PATH: /orders/{id}
+#  PATH: /orders/bulk
+######################################################################
+
+
+@API.route('/orders/bulk')
+class OrderBulk(Resource):
+    """ Creates many Orders in one request """
+
+    # ------------------------------------------------------------------
+    # CREATE ORDERS
+    # ------------------------------------------------------------------
+    @API.doc('create_orders_bulk')
+    @API.response(400, 'The posted data was not a list of orders')
+    @API.expect([order_create_model])
+    @API.marshal_list_with(order_bulk_result_model, skip_none=True)
+    def post(self):
+        """
+        Creates many Orders
+
+        This endpoint validates every Order in the posted list and creates the
+        valid ones with their items in a single transaction. The result of
+        every Order is returned at the same position as in the request
+        """
+        data = API.payload
+        if not isinstance(data, list):
+            raise DataValidationError(
+                "Invalid request: body must be a list of orders")
+        if len(data) > APP.config['MAX_BULK_SIZE']:
+            raise DataValidationError(
+                f"Invalid request: at most {APP.config['MAX_BULK_SIZE']} "
+                "orders can be created at once")
+        APP.logger.info("Request to create %d orders", len(data))
+
+        results = []
+        orders = []
+        for index, order_data in enumerate(data):
+            try:
+                orders.append(Order().deserialize(order_data))
+                results.append({'index': index})
+            except DataValidationError as error:
+                results.append({
+                    'index': index,
+                    'status_code': status.HTTP_400_BAD_REQUEST,
+                    'message': str(error),
+                })
+
+        created = iter(Order.create_many(orders))
+        for result in results:
+            if 'status_code' not in result:
+                result['status_code'] = status.HTTP_201_CREATED
+                result['order'] = next(created).serialize()
+        APP.logger.info('Created %d of %d orders', len(orders), len(data))
+        return results, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /orders/transitions
+######################################################################
+
+
+@API.route('/orders/transitions')
+class OrderTransitions(Resource):
+    """ Moves many Orders to a new status in one request """
+
+    # ------------------------------------------------------------------
+    # MOVE ORDERS
+    # ------------------------------------------------------------------
+    @API.doc('transition_orders')
+    @API.response(400, 'The posted data or the filters were not valid')
+    @API.expect(filter_args, order_transition_model)
+    @API.marshal_list_with(order_transition_result_model, skip_none=True)
+    def post(self):
+        """
+        Moves many Orders to a new status
+
+        This endpoint moves the Orders with the posted ids, or else every Order
+        that matches the query string filters, to the posted status with a
+        single UPDATE. Orders whose status cannot move there are left alone.
+        The result of every posted id is returned, or only the moved Orders
+        when the Orders were chosen by the filters
+        """
+        data = API.payload
+        if not isinstance(data, dict):
+            raise DataValidationError(
+                "Invalid request: body must contain the status to move to")
+        try:
+            target = order_status(data.get('to'))
+        except ValueError as error:
+            raise DataValidationError(f"Invalid request: {error}") from error
+        ids = data.get('ids')
+        filters = order_filters(filter_args.parse_args())
+        if ids is None and all(value is None for value in filters.values()):
+            raise DataValidationError(
+                "Invalid request: give the ids of the orders or a filter")
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                raise DataValidationError("Invalid request: ids must be a list of integers")
+            if len(ids) > APP.config['MAX_BULK_SIZE']:
+                raise DataValidationError(
+                    f"Invalid request: at most {APP.config['MAX_BULK_SIZE']} "
+                    "orders can be moved at once")
+        APP.logger.info("Request to move orders to %s", target.name)
+
+        updated = Order.transition(target, ids, **filters)
+        if ids is None:
+            results = [{'id': order_id, 'status_code': status.HTTP_200_OK,
+                        'status': target.name} for order_id in updated]
+        else:
+            results = self.results_of(ids, updated, target)
+        APP.logger.info("Moved %d orders to %s", len(updated), target.name)
+        return results, status.HTTP_200_OK
+
+    @staticmethod
+    def results_of(ids, updated, target):
+        """ Returns the outcome of every posted id in the order they were posted """
+        moved = set(updated)
+        current = Order.find_statuses(set(ids) - moved)
+        results = []
+        for order_id in dict.fromkeys(ids):
+            if order_id in moved:
+                results.append({'id': order_id, 'status_code': status.HTTP_200_OK,
+                                'status': target.name})
+            elif order_id in current:
+                results.append({
+                    'id': order_id,
+                    'status_code': status.HTTP_409_CONFLICT,
+                    'status': current[order_id].name,
+                    'message': f"Cannot move order from {current[order_id].name} "
+                               f"to {target.name}",
+                })
+            else:
+                results.append({
+                    'id': order_id,
+                    'status_code': status.HTTP_404_NOT_FOUND,
+                    'message': f"Order with id '{order_id}' was not found.",
+                })
+        return results
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+
+
+@API.route('/orders/changes')
+class OrderChanges(Resource):
+    """ The feed of Orders and Items written or deleted since a cursor """
+
+    # ------------------------------------------------------------------
+    # LIST CHANGES
+    # ------------------------------------------------------------------
+    @API.doc('list_order_changes')
+    @API.expect(change_args, validate=True)
+    @API.marshal_with(order_change_feed_model)
+    def get(self):
+        """
+        Returns the Orders and Items changed since a cursor
+
+        Every changed record is returned once, as it is now, or as a deleted
+        tombstone when it no longer exists. Pass the returned cursor as since
+        to read the changes that follow, until more is false
+        """
+        args = change_args.parse_args()
+        APP.logger.info("Request for order changes since %s", args['since'])
+        since = decode_cursor(args['since'])
+        limit = args['limit'] or APP.config['MAX_PAGE_SIZE']
+        feed, page = Change.feed(since, limit, RECORD_MODELS,
+                                 APP.config['CHANGE_FEED_LAG'])
+        changes = []
+        for change, record in feed:
+            result = {
+                'seq': change.seq,
+                'type': change.record_type,
+                'id': change.record_id,
+                'order_id': change.order_id,
+                'deleted': record is None,
+            }
+            if record is not None:
+                result[change.record_type] = record.serialize()
+            changes.append(result)
+        last_seq = page[-1].seq if page else since or 0
+        return {
+            'changes': changes,
+            'cursor': encode_cursor(last_seq),
+            'more': len(page) == limit,
+        }, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /orders/stats
+######################################################################
+
+
+@API.route('/orders/stats')
+class OrderStats(Resource):
+    """ Totals of Orders and their items computed by the database """
+
+    # ------------------------------------------------------------------
+    # ORDER STATS
+    # ------------------------------------------------------------------
+    @API.doc('order_stats')
+    @API.expect(stats_args, validate=True)
+    @API.marshal_list_with(order_stats_model)
+    def get(self):
+        """
+        Returns the Order totals per group
+
+        This endpoint returns the number of orders, the number of items and
+        the sum of price * quantity for every status or customer
+        """
+        args = stats_args.parse_args()
+        APP.logger.info("Request for order stats by %s", args['group_by'])
+        results = queries.order_stats(args['group_by'], **order_filters(args))
+        return results, status.HTTP_200_OK
+
+######################################################################
+#  PATH: /orders/export
+######################################################################
+
+
+@API.route('/orders/export')
+class OrderExport(Resource):
+    """ Streams every Order as one JSON document per line """
+
+    # ------------------------------------------------------------------
+    # EXPORT ORDERS
+    # ------------------------------------------------------------------
+    @API.doc('export_orders')
+    @API.expect(export_args, validate=True)
+    @API.produces(['application/x-ndjson'])
+    def get(self):
+        """
+        Exports the Orders
+
+        This endpoint streams the Orders with their items as newline delimited
+        JSON, reading them from the database in batches of EXPORT_BATCH_SIZE
+        as plain rows
+        """
+        APP.logger.info("Request to export orders")
+        args = export_args.parse_args()
+        batches = queries.iterate_order_rows(serializers.OrderRecord.COLUMNS,
+                                             serializers.ItemRecord.COLUMNS,
+                                             APP.config['EXPORT_BATCH_SIZE'],
+                                             **order_filters(args))
+
+        def generate():
+            for order_rows, item_rows in batches:
+                for order in serializers.order_records(order_rows, item_rows):
+                    yield json.dumps(order.serialize()) + "\n"
+
+        return Response(stream_with_context(generate()),
+                        status=status.HTTP_200_OK,
+                        mimetype='application/x-ndjson')
+
+######################################################################
+#  PATH: /orders/{id}/cancel
 ######################################################################
 
 
-@API.route('/orders/<order_id>/cancel')
+@API.route('/orders/<int:order_id>/cancel')
 @API.param('order_id', 'The Order identifier')
 class OrderCancel(Resource):
     """ Cancel an Order """
@@ -0,0 +1,221 @@
+"""
+This module contains the fast path that turns query rows straight into JSON.
+
+The documents have the same keys, in the same order, as the ones that
+flask_restx marshals with order_model and item_model, so a list serialized
+here is byte for byte the one the marshalling path returns. They are encoded
+with orjson when it is installed and otherwise with the compact separators
+that RESTX_JSON sets for every other response.
+
+A Projection names the fields a request asked for with fields=, and its
+columns are the only ones that are read from the database.
+
+Routes that need the records themselves, e.g. to compute an ETag or to
+serialize them the way the models do, read them as ItemRecord and
+OrderRecord objects: plain rows kept in slots, without the identity map,
+change tracking and relationships that the ORM sets up for every object.
+"""
+import json
+from service.instrumentation import timed_serialization
+from service.models import DataValidationError, Item, Order
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# The fields of the documents, in the order that flask_restx marshals them
+ORDER_FIELDS = ("items", "id", "total_amount", "item_count", "customer_id",
+                "tracking_id", "status")
+ITEM_FIELDS = ("order_id", "id", "product_id", "quantity", "price")
+
+
+class Projection():
+    """
+    The fields of the Order and Item documents that a request asked for
+
+    The columns are those that have to be read to build the documents: the
+    ids that rows are keyed by, followed by the requested fields
+    """
+
+    def __init__(self, order_fields=ORDER_FIELDS, item_fields=ITEM_FIELDS):
+        self.order_fields = tuple(f for f in ORDER_FIELDS if f in order_fields)
+        self.item_fields = tuple(f for f in ITEM_FIELDS if f in item_fields)
+        self.order_columns = ("id",) + tuple(
+            f for f in self.order_fields if f not in ("items", "id"))
+        self.item_columns = ("id", "order_id") + tuple(
+            f for f in self.item_fields if f not in ("id", "order_id"))
+
+    @property
+    def includes_items(self):
+        """ True if the Order documents contain their items """
+        return "items" in self.order_fields
+
+    @property
+    def order_item_columns(self):
+        """ The columns of the items of an Order, None if they are not included """
+        return self.item_columns if self.includes_items else None
+
+    def key(self):
+        """ Returns a string that tells the projections apart, used in ETags """
+        return ",".join(self.order_fields) + ";" + ",".join(self.item_fields)
+
+
+FULL_PROJECTION = Projection()
+
+
+class ItemRecord():  # pylint: disable=too-few-public-methods
+    """ A read-only Item built from a row of ItemRecord.COLUMNS """
+    COLUMNS = ("id", "order_id", "product_id", "quantity", "price", "version")
+    __slots__ = COLUMNS
+    model_name = "Item"
+
+    def __init__(self, row):
+        (self.id, self.order_id, self.product_id,  # pylint: disable=invalid-name
+         self.quantity, self.price, self.version) = row
+
+    # the slots have the names of the model's attributes, so it serializes them
+    serialize = Item.serialize
+
+
+class OrderRecord():  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """ A read-only Order built from a row of OrderRecord.COLUMNS and its items """
+    COLUMNS = ("id", "customer_id", "tracking_id", "status", "total_amount",
+               "item_count", "version")
+    __slots__ = COLUMNS + ("items",)
+    model_name = "Order"
+
+    def __init__(self, row, items):
+        (self.id, self.customer_id, self.tracking_id,  # pylint: disable=invalid-name
+         self.status, self.total_amount, self.item_count, self.version) = row
+        self.items = items
+
+    serialize = Order.serialize
+
+
+def item_records(item_rows):
+    """ Returns the ItemRecords of rows read with ItemRecord.COLUMNS """
+    return [ItemRecord(row) for row in item_rows]
+
+
+def order_records(order_rows, item_rows):
+    """
+    Returns the OrderRecords of rows read with OrderRecord.COLUMNS
+
+    The item rows are grouped by their order_id in a single pass
+    """
+    items = {}
+    for row in item_rows:
+        items.setdefault(row[1], []).append(ItemRecord(row))
+    return [OrderRecord(row, items.get(row[0], [])) for row in order_rows]
+
+
+def parse_fields(value):
+    """ Splits the value of fields= into names, None if it was not given """
+    if value is None:
+        return None
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    if not names:
+        raise DataValidationError("fields must name at least one field")
+    return names
+
+
+def order_projection(value):
+    """
+    Parses fields= of the Order routes, e.g. id,status,items.product_id
+
+    items selects every field of the items, items.<field> only that one
+    """
+    names = parse_fields(value)
+    if names is None:
+        return FULL_PROJECTION
+    order_fields, item_fields = set(), set()
+    for name in names:
+        if name == "items":
+            order_fields.add(name)
+            item_fields.update(ITEM_FIELDS)
+        elif name.startswith("items.") and name[6:] in ITEM_FIELDS:
+            order_fields.add("items")
+            item_fields.add(name[6:])
+        elif name in ORDER_FIELDS:
+            order_fields.add(name)
+        else:
+            raise DataValidationError(f"Orders have no field '{name}'")
+    return Projection(order_fields, item_fields)
+
+
+def item_projection(value):
+    """ Parses fields= of the Item routes, e.g. id,product_id """
+    names = parse_fields(value)
+    if names is None:
+        return FULL_PROJECTION
+    for name in names:
+        if name not in ITEM_FIELDS:
+            raise DataValidationError(f"Items have no field '{name}'")
+    return Projection((), names)
+
+
+def item_row_builder(projection):
+    """ Returns a function that builds the document of an Item row """
+    positions = [(name, projection.item_columns.index(name))
+                 for name in projection.item_fields]
+
+    def build(row):
+        return {name: row[index] for name, index in positions}
+    return build
+
+
+@timed_serialization
+def item_documents(item_rows, projection=FULL_PROJECTION):
+    """ Returns the JSON documents of Item rows read with the item columns """
+    build = item_row_builder(projection)
+    return [build(row) for row in item_rows]
+
+
+@timed_serialization
+def order_documents(order_rows, item_rows, projection=FULL_PROJECTION):
+    """ Returns the JSON documents of Order rows, each with its Item rows """
+    items = {}
+    if projection.includes_items:
+        build = item_row_builder(projection)
+        for row in item_rows:
+            items.setdefault(row[1], []).append(build(row))
+    positions = [(name, projection.order_columns.index(name))
+                 for name in projection.order_fields if name != "items"]
+    documents = []
+    for row in order_rows:
+        # items comes first in ORDER_FIELDS, so it keeps its place here
+        document = {"items": items.get(row[0], [])} if projection.includes_items else {}
+        for name, index in positions:
+            document[name] = row[index]
+        if "status" in document:
+            document["status"] = document["status"].name
+        documents.append(document)
+    return documents
+
+
+def item_document(item, projection):
+    """ Returns the JSON document of an Item object """
+    return {name: getattr(item, name) for name in projection.item_fields}
+
+
+@timed_serialization
+def order_document(order, projection):
+    """ Returns the JSON document of an Order object """
+    document = {}
+    for name in projection.order_fields:
+        if name == "items":
+            document[name] = [item_document(item, projection) for item in order.items]
+        elif name == "status":
+            document[name] = order.status.name
+        else:
+            document[name] = getattr(order, name)
+    return document
+
+
+@timed_serialization
+def dumps(data):
+    """ Encodes documents as a JSON body that ends with a new line """
+    if orjson is not None:
+        return orjson.dumps(data) + b"\n"  # pylint: disable=no-member
+    return (json.dumps(data, separators=(",", ":")) + "\n").encode("utf-8")
@@ -0,0 +1,110 @@
+"""
+Test cases for the Order cache
+"""
+import json
+from unittest import TestCase
+from service.cache import (LRUCache, NullCache, OrderCache, RedisCache,
+                           create_cache)
+
+
+class FakeRedis():
+    """ Stands in for redis.Redis with a dictionary and a fake clock """
+
+    def __init__(self):
+        self.data = {}
+        self.now = 0
+
+    def get(self, key):
+        """ Returns the value of an unexpired key """
+        value, expires = self.data.get(key, (None, 0))
+        return value if expires > self.now else None
+
+    def setex(self, key, ttl, value):
+        """ Stores a value that expires after ttl seconds """
+        self.data[key] = (value.encode("utf-8"), self.now + ttl)
+
+    def delete(self, *keys):
+        """ Removes keys """
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        """ Returns the keys that start with the prefix of the pattern """
+        return [key for key in self.data if key.startswith(match.rstrip("*"))]
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+
+
+class TestCache(TestCase):
+    """ Test Cases for the Order cache """
+
+    def test_lru_cache(self):
+        """ Evict the least recently used entry from a full cache """
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("1", {"id": 1})
+        cache.set("2", {"id": 2})
+        self.assertEqual(cache.get("1"), {"id": 1})
+        cache.set("3", {"id": 3})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("2"))
+        self.assertEqual(cache.get("1"), {"id": 1})
+        cache.delete("1")
+        self.assertIsNone(cache.get("1"))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_cache_ttl(self):
+        """ Expire entries of the cache once their TTL has run out """
+        now = [0]
+        cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set("1", {"id": 1})
+        now[0] = 9
+        self.assertEqual(cache.get("1"), {"id": 1})
+        now[0] = 10
+        self.assertIsNone(cache.get("1"))
+        self.assertEqual(len(cache), 0)
+
+    def test_redis_cache(self):
+        """ Store payloads as JSON in a Redis compatible client """
+        client = FakeRedis()
+        cache = RedisCache(client, ttl=10)
+        cache.set("1", {"id": 1})
+        self.assertEqual(json.loads(client.data["orders:cache:1"][0]), {"id": 1})
+        self.assertEqual(cache.get("1"), {"id": 1})
+        client.now = 10
+        self.assertIsNone(cache.get("1"))
+        client.now = 0
+        cache.set("2", {"id": 2})
+        cache.delete("2")
+        self.assertIsNone(cache.get("2"))
+        cache.set("3", {"id": 3})
+        cache.clear()
+        self.assertEqual(client.data, {})
+
+    def test_order_cache_counters(self):
+        """ Count the hits and misses of the Order cache """
+        cache = OrderCache(LRUCache())
+        self.assertIsNone(cache.get(1))
+        cache.set("1", {"id": 1})
+        self.assertEqual(cache.get(1), {"id": 1})
+        self.assertEqual(cache.get("01"), {"id": 1})
+        self.assertIsNone(cache.get("abc"))
+        cache.set("abc", {"id": 2})
+        self.assertEqual(cache.stats(),
+                         {"backend": "LRUCache", "hits": 2, "misses": 2})
+        cache.invalidate(1, None, "abc")
+        self.assertIsNone(cache.get(1))
+
+    def test_create_cache(self):
+        """ Create the cache backend named in the configuration """
+        cache = create_cache({"CACHE_BACKEND": "memory", "CACHE_MAXSIZE": 5})
+        self.assertEqual(cache.backend.maxsize, 5)
+        cache = create_cache({"CACHE_BACKEND": "none"})
+        self.assertIsInstance(cache.backend, NullCache)
+        cache.set(1, {"id": 1})
+        self.assertIsNone(cache.get(1))
+        cache.clear()
+        self.assertRaises(ValueError, create_cache, {"CACHE_BACKEND": "disk"})